@@ -0,0 +1,520 @@
+# ---------------------------------------------------------------------------
+# fakeapi.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+#
+# ベンチマーク用の最小限の Kubernetes API サーバ。
+# Deployment, StatefulSet (scale/status サブリソースを含む), Pod, Event, Secret の
+# list / watch / get / patch / delete に対応し、ワークロードは設定した遅延の後に Ready になる。
+# DaemonSet は create / get / delete に対応し、遅延の後に各ノードでイメージを取得済みの Pod が作成される。
+#
+# 管理用エンドポイント:
+#   POST /fake/releases  helm の Release を作成する (fake helm が使用する)
+#   POST /fake/seed      ワークロードをまとめて作成する
+#   GET  /fake/stats     API リクエスト数を返す
+#   POST /fake/reset     リクエスト数をリセットする
+
+import argparse
+import base64
+import collections
+import copy
+import datetime
+import gzip
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# watch で遡れるイベント履歴の件数。これより古い resourceVersion を指定された場合は 410 Gone を返す
+HISTORY_SIZE = 20000
+
+# リソース名と kind, apiVersion の対応
+RESOURCES = {
+    'deployments': ('Deployment', 'apps/v1'),
+    'statefulsets': ('StatefulSet', 'apps/v1'),
+    'pods': ('Pod', 'v1'),
+    'events': ('Event', 'v1'),
+    'secrets': ('Secret', 'v1'),
+    'daemonsets': ('DaemonSet', 'apps/v1'),
+}
+
+# DaemonSet の Pod を配置するノード数
+NODES = 3
+
+ROUTES = [
+    ('collection', re.compile(r'^/apis?/(?:apps/)?v1/namespaces/(?P<ns>[^/]+)/(?P<res>[a-z]+)$')),
+    ('collection', re.compile(r'^/apis?/(?:apps/)?v1/(?P<res>[a-z]+)$')),
+    ('object', re.compile(r'^/apis?/(?:apps/)?v1/namespaces/(?P<ns>[^/]+)/(?P<res>[a-z]+)/(?P<name>[^/]+)$')),
+    ('subresource',
+     re.compile(r'^/apis?/(?:apps/)?v1/namespaces/(?P<ns>[^/]+)/(?P<res>[a-z]+)/(?P<name>[^/]+)/(?P<sub>scale|status)$')),
+]
+
+
+def now_iso() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_selector(selector: str) -> list:
+    """ラベルセレクタ (k=v, k==v, k!=v, k, !k) を (key, op, value) のリストに変換する。
+    """
+    result = []
+    for term in filter(None, (x.strip() for x in (selector or '').split(','))):
+        m = re.match(r'^(!?)([^=!]+?)\s*(?:(==|=|!=)\s*(.*))?$', term)
+        if m.group(3):
+            result.append((m.group(2), '!=' if m.group(3) == '!=' else '=', m.group(4)))
+        else:
+            result.append((m.group(2), '!' if m.group(1) else 'exists', None))
+    return result
+
+
+def match_selector(selector: list, labels: dict) -> bool:
+    labels = labels or {}
+    for key, op, value in selector:
+        if op == '=' and labels.get(key) != value:
+            return False
+        if op == '!=' and labels.get(key) == value:
+            return False
+        if op == 'exists' and key not in labels:
+            return False
+        if op == '!' and key in labels:
+            return False
+    return True
+
+
+def match_fields(selector: str, obj: dict) -> bool:
+    """フィールドセレクタ (metadata.name=x, metadata.namespace!=y) を評価する。
+    """
+    for term in filter(None, (x.strip() for x in (selector or '').split(','))):
+        m = re.match(r'^([^=!]+?)\s*(==|=|!=)\s*(.*)$', term)
+        value = obj
+        for part in m.group(1).split('.'):
+            value = value.get(part, {}) if isinstance(value, dict) else {}
+        value = value if isinstance(value, str) else ''
+        if (m.group(2) == '!=') == (value == m.group(3)):
+            return False
+    return True
+
+
+class FakeCluster:
+    """API サーバが保持するオブジェクトと、watch 用のイベント履歴"""
+    def __init__(self, ready_delay: float = 1.0, terminate_delay: float = 0.5):
+        self.ready_delay = ready_delay
+        self.terminate_delay = terminate_delay
+        self.cond = threading.Condition()
+        self.resource_version = 1
+        self.objects = {res: {} for res in RESOURCES}
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.requests = collections.Counter()
+
+    # ---- オブジェクト操作 ----
+
+    def _emit(self, res: str, event_type: str, obj: dict) -> None:
+        """resourceVersion を進めてイベント履歴に追加する。cond のロックを保持した状態で呼び出すこと。"""
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.history.append((self.resource_version, res, event_type, copy.deepcopy(obj)))
+        self.cond.notify_all()
+
+    def put(self, res: str, obj: dict) -> None:
+        with self.cond:
+            key = (obj['metadata']['namespace'], obj['metadata']['name'])
+            event_type = 'MODIFIED' if key in self.objects[res] else 'ADDED'
+            obj['metadata'].setdefault('creationTimestamp', now_iso())
+            obj['metadata'].setdefault('uid', '%s-%s-%s' % (res, key[0], key[1]))
+            self.objects[res][key] = obj
+            self._emit(res, event_type, obj)
+
+    def delete(self, res: str, ns: str, name: str) -> dict:
+        with self.cond:
+            obj = self.objects[res].pop((ns, name), None)
+            if obj is not None:
+                self._emit(res, 'DELETED', obj)
+                if res in ('deployments', 'statefulsets'):
+                    self._sync_pods(res, obj, 0)
+                elif res == 'daemonsets':
+                    for i in range(NODES):
+                        pod = self.objects['pods'].pop((ns, '%s-node%d' % (name, i)), None)
+                        if pod is not None:
+                            self._emit('pods', 'DELETED', pod)
+            return obj
+
+    def create_daemonset(self, ns: str, obj: dict) -> dict:
+        """DaemonSet を作成する。ready_delay 秒後に、全コンテナのイメージを取得済みの Pod を各ノードに作成する。"""
+        name = obj['metadata']['name']
+        obj['metadata']['namespace'] = ns
+        obj['status'] = {'desiredNumberScheduled': NODES, 'currentNumberScheduled': NODES, 'numberMisscheduled': 0,
+                         'numberReady': 0}
+        with self.cond:
+            if (ns, name) in self.objects['daemonsets']:
+                return None
+            self.put('daemonsets', obj)
+
+        def apply():
+            with self.cond:
+                if self.objects['daemonsets'].get((ns, name)) is not obj:
+                    return
+                template = obj['spec']['template']
+                for i in range(NODES):
+                    containers = template['spec']['containers']
+                    pod = {'apiVersion': 'v1', 'kind': 'Pod',
+                           'metadata': {'name': '%s-node%d' % (name, i), 'namespace': ns,
+                                        'labels': dict(template['metadata'].get('labels') or {}),
+                                        'creationTimestamp': now_iso(), 'uid': 'pod-%s-%s-node%d' % (ns, name, i)},
+                           'spec': template['spec'],
+                           'status': {'phase': 'Running',
+                                      'containerStatuses': [{'name': c['name'], 'image': c['image'],
+                                                             'imageID': 'fake://' + c['image'], 'ready': True,
+                                                             'restartCount': 0,
+                                                             'state': {'running': {'startedAt': now_iso()}}}
+                                                            for c in containers]}}
+                    self.objects['pods'][(ns, pod['metadata']['name'])] = pod
+                    self._emit('pods', 'ADDED', pod)
+
+        timer = threading.Timer(self.ready_delay, apply)
+        timer.daemon = True
+        timer.start()
+        return obj
+
+    def create_workload(self, res: str, ns: str, name: str, replicas: int, release: str = None,
+                        labels: dict = None, ready_delay: float = None) -> None:
+        """ワークロードを作成する。Pod と Ready 状態は ready_delay 秒後に反映される。"""
+        kind, api_version = RESOURCES[res]
+        match_labels = {'app': name}
+        annotations = {'meta.helm.sh/release-name': release, 'meta.helm.sh/release-namespace': ns} if release else {}
+        obj = {
+            'apiVersion': api_version, 'kind': kind,
+            'metadata': {'name': name, 'namespace': ns, 'annotations': annotations,
+                         'labels': dict(labels or {}, **match_labels, **({'release': release} if release else {}))},
+            'spec': {'replicas': replicas, 'selector': {'matchLabels': match_labels},
+                     'template': {'metadata': {'labels': match_labels},
+                                  'spec': {'containers': [{'name': name, 'image': 'fake/%s:latest' % name}]}}},
+            'status': {'replicas': 0, 'readyReplicas': 0},
+        }
+        if res == 'statefulsets':
+            obj['spec']['serviceName'] = name
+        self.put(res, obj)
+        self._schedule(res, ns, name, replicas, self.ready_delay if ready_delay is None else ready_delay)
+
+    def scale(self, res: str, ns: str, name: str, replicas: int) -> dict:
+        """spec.replicas を変更する。status はスケールダウンなら terminate_delay、スケールアップなら ready_delay 秒後に反映される。"""
+        with self.cond:
+            obj = self.objects[res].get((ns, name))
+            if obj is None:
+                return None
+            current = obj['spec'].get('replicas', 0)
+            if current != replicas:
+                obj['spec']['replicas'] = replicas
+                self._emit(res, 'MODIFIED', obj)
+                delay = self.terminate_delay if replicas < current else self.ready_delay
+                self._schedule(res, ns, name, replicas, delay)
+            return obj
+
+    def _schedule(self, res: str, ns: str, name: str, replicas: int, delay: float) -> None:
+        def apply():
+            with self.cond:
+                obj = self.objects[res].get((ns, name))
+                if obj is None or obj['spec'].get('replicas') != replicas:
+                    return
+                obj['status'] = {'replicas': replicas, 'readyReplicas': replicas, 'availableReplicas': replicas,
+                                 'observedGeneration': 1}
+                self._emit(res, 'MODIFIED', obj)
+                self._sync_pods(res, obj, replicas)
+        timer = threading.Timer(delay, apply)
+        timer.daemon = True
+        timer.start()
+
+    def _sync_pods(self, res: str, workload: dict, replicas: int) -> None:
+        """ワークロードのレプリカ数に合わせて Pod を作成・削除する。cond のロックを保持した状態で呼び出すこと。"""
+        ns = workload['metadata']['namespace']
+        name = workload['metadata']['name']
+        labels = workload['spec']['selector']['matchLabels']
+        owner = {'kind': RESOURCES[res][0], 'name': name, 'apiVersion': 'apps/v1', 'uid': workload['metadata']['uid']}
+        for i in range(max(replicas, 0), 1000):
+            pod = self.objects['pods'].pop((ns, '%s-%d' % (name, i)), None)
+            if pod is None:
+                break
+            self._emit('pods', 'DELETED', pod)
+        for i in range(replicas):
+            key = (ns, '%s-%d' % (name, i))
+            if key in self.objects['pods']:
+                continue
+            pod = {'apiVersion': 'v1', 'kind': 'Pod',
+                   'metadata': {'name': key[1], 'namespace': ns, 'labels': dict(labels), 'ownerReferences': [owner],
+                                'creationTimestamp': now_iso(), 'uid': 'pod-%s-%s' % key},
+                   'spec': {'containers': [{'name': name, 'image': 'fake/%s:latest' % name}]},
+                   'status': {'phase': 'Running', 'conditions': [{'type': 'Ready', 'status': 'True'}],
+                              'containerStatuses': [{'name': name, 'ready': True, 'restartCount': 0,
+                                                     'image': 'fake/%s:latest' % name, 'imageID': 'fake',
+                                                     'state': {'running': {'startedAt': now_iso()}}}]}}
+            self.objects['pods'][key] = pod
+            self._emit('pods', 'ADDED', pod)
+
+    def create_release(self, ns: str, release: str, deployments: int, statefulsets: int, replicas: int = 1) -> None:
+        """helm install 相当の処理として、Release の Secret とワークロードを作成する。"""
+        with self.cond:
+            revisions = [obj for (n, _), obj in self.objects['secrets'].items()
+                         if n == ns and obj['metadata']['labels'].get('name') == release]
+            for old in revisions:
+                old['metadata']['labels']['status'] = 'superseded'
+                self._emit('secrets', 'MODIFIED', old)
+        revision = len(revisions) + 1
+        payload = {'name': release, 'namespace': ns, 'version': revision, 'info': {'status': 'deployed',
+                                                                                    'last_deployed': now_iso()},
+                   'chart': {'metadata': {'name': 'onap', 'version': '0.0.0-fake'}}}
+        data = base64.b64encode(base64.b64encode(gzip.compress(json.dumps(payload).encode()))).decode()
+        self.put('secrets', {'apiVersion': 'v1', 'kind': 'Secret', 'type': 'helm.sh/release.v1',
+                             'metadata': {'name': 'sh.helm.release.v1.%s.v%d' % (release, revision), 'namespace': ns,
+                                          'labels': {'owner': 'helm', 'name': release, 'status': 'deployed',
+                                                     'version': str(revision)}},
+                             'data': {'release': data}})
+        for i in range(deployments):
+            self.create_workload('deployments', ns, '%s-d%d' % (release, i), replicas, release)
+        for i in range(statefulsets):
+            self.create_workload('statefulsets', ns, '%s-s%d' % (release, i), replicas, release)
+
+    # ---- 参照 ----
+
+    def list(self, res: str, ns: str = None, label_selector: str = None, field_selector: str = None) -> tuple:
+        selector = parse_selector(label_selector)
+        with self.cond:
+            items = [copy.deepcopy(obj) for (n, _), obj in sorted(self.objects[res].items())
+                     if (ns is None or n == ns) and match_selector(selector, obj['metadata'].get('labels'))
+                     and match_fields(field_selector, obj)]
+            return items, self.resource_version
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {'total': sum(self.requests.values()), 'requests': dict(self.requests)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    cluster = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, code: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _status(self, code: int, reason: str, message: str = '') -> dict:
+        return {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code, 'reason': reason,
+                'message': message, 'metadata': {}}
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _route(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        for name, pattern in reversed(ROUTES):
+            m = pattern.match(url.path)
+            if m and m.group('res') in RESOURCES:
+                return name, m.groupdict(), params, url.path
+        return None, {}, params, url.path
+
+    def _count(self, verb: str, groups: dict) -> None:
+        with self.cluster.cond:
+            self.cluster.requests['%s %s%s' % (verb, groups.get('res', '?'),
+                                               '/' + groups['sub'] if groups.get('sub') else '')] += 1
+
+    def do_GET(self):
+        route, groups, params, path = self._route()
+        if path == '/fake/stats':
+            return self._send_json(200, self.cluster.stats())
+        if route is None:
+            return self._send_json(404, self._status(404, 'NotFound', path))
+        res = groups['res']
+        if route == 'collection':
+            if params.get('watch') in ('true', '1', 'True'):
+                self._count('WATCH', groups)
+                return self._watch(res, groups.get('ns'), params)
+            self._count('LIST', groups)
+            items, rv = self.cluster.list(res, groups.get('ns'), params.get('labelSelector'),
+                                          params.get('fieldSelector'))
+            kind, api_version = RESOURCES[res]
+            return self._send_json(200, {'kind': kind + 'List', 'apiVersion': api_version,
+                                         'metadata': {'resourceVersion': str(rv)}, 'items': items})
+        self._count('GET', groups)
+        with self.cluster.cond:
+            obj = copy.deepcopy(self.cluster.objects[res].get((groups['ns'], groups['name'])))
+        if obj is None:
+            return self._send_json(404, self._status(404, 'NotFound', groups['name']))
+        if groups.get('sub') == 'scale':
+            obj = self._scale_of(obj)
+        return self._send_json(200, obj)
+
+    def _scale_of(self, obj: dict) -> dict:
+        return {'kind': 'Scale', 'apiVersion': 'autoscaling/v1',
+                'metadata': {'name': obj['metadata']['name'], 'namespace': obj['metadata']['namespace'],
+                             'resourceVersion': obj['metadata']['resourceVersion']},
+                'spec': {'replicas': obj['spec'].get('replicas', 0)},
+                'status': {'replicas': obj['status'].get('replicas', 0)}}
+
+    def do_PATCH(self):
+        route, groups, params, path = self._route()
+        if route not in ('subresource', 'object') or groups['res'] not in ('deployments', 'statefulsets'):
+            return self._send_json(405, self._status(405, 'MethodNotAllowed', path))
+        self._count('PATCH', groups)
+        body = self._read_body()
+        if isinstance(body, list):
+            # JSON Patch (replace /spec/replicas のみ対応)
+            replicas = next((op.get('value') for op in body if op.get('path') == '/spec/replicas'), None)
+        else:
+            replicas = (body.get('spec') or {}).get('replicas')
+        with self.cluster.cond:
+            obj = self.cluster.objects[groups['res']].get((groups['ns'], groups['name']))
+        if obj is None:
+            return self._send_json(404, self._status(404, 'NotFound', groups['name']))
+        if replicas is not None:
+            obj = self.cluster.scale(groups['res'], groups['ns'], groups['name'], int(replicas))
+        with self.cluster.cond:
+            obj = copy.deepcopy(obj)
+        return self._send_json(200, self._scale_of(obj) if groups.get('sub') == 'scale' else obj)
+
+    def do_DELETE(self):
+        route, groups, params, path = self._route()
+        if route != 'object':
+            return self._send_json(405, self._status(405, 'MethodNotAllowed', path))
+        self._count('DELETE', groups)
+        obj = self.cluster.delete(groups['res'], groups['ns'], groups['name'])
+        if obj is None:
+            return self._send_json(404, self._status(404, 'NotFound', groups['name']))
+        return self._send_json(200, obj)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self._read_body()
+        route, groups, params, path = self._route()
+        if route == 'collection' and groups.get('ns') and groups['res'] == 'daemonsets':
+            self._count('CREATE', groups)
+            obj = self.cluster.create_daemonset(groups['ns'], body)
+            if obj is None:
+                return self._send_json(409, self._status(409, 'AlreadyExists', body['metadata']['name']))
+            with self.cluster.cond:
+                return self._send_json(201, copy.deepcopy(obj))
+        if url.path == '/fake/releases':
+            self.cluster.create_release(body['namespace'], body['release'], int(body.get('deployments', 1)),
+                                        int(body.get('statefulsets', 0)), int(body.get('replicas', 1)))
+            return self._send_json(201, {})
+        if url.path == '/fake/seed':
+            for i in range(int(body.get('deployments', 0))):
+                self.cluster.create_workload('deployments', body['namespace'], 'seed-d%d' % i, 1, body.get('release'),
+                                             ready_delay=0)
+            for i in range(int(body.get('statefulsets', 0))):
+                self.cluster.create_workload('statefulsets', body['namespace'], 'seed-s%d' % i, 1,
+                                             body.get('release'), ready_delay=0)
+            return self._send_json(201, {})
+        if url.path == '/fake/reset':
+            with self.cluster.cond:
+                self.cluster.requests.clear()
+            return self._send_json(200, {})
+        return self._send_json(404, self._status(404, 'NotFound', url.path))
+
+    def _watch(self, res: str, ns: str, params: dict) -> None:
+        """チャンク転送で watch イベントを送信する。timeoutSeconds が経過したら終了する。"""
+        selector = parse_selector(params.get('labelSelector'))
+        field_selector = params.get('fieldSelector')
+        timeout = min(float(params.get('timeoutSeconds') or 1800), 1800)
+        deadline = time.monotonic() + timeout
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send(event: dict) -> None:
+            data = json.dumps(event).encode() + b'\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def matches(obj: dict) -> bool:
+            return ((ns is None or obj['metadata']['namespace'] == ns)
+                    and match_selector(selector, obj['metadata'].get('labels'))
+                    and match_fields(field_selector, obj))
+
+        try:
+            rv_param = params.get('resourceVersion')
+            with self.cluster.cond:
+                oldest = self.cluster.history[0][0] if self.cluster.history else self.cluster.resource_version
+                initial = []
+                if not rv_param or rv_param == '0':
+                    # resourceVersion が指定されない場合は現在の全オブジェクトを ADDED として送る
+                    initial = [copy.deepcopy(o) for o in self.cluster.objects[res].values() if matches(o)]
+                    rv = self.cluster.resource_version
+                else:
+                    rv = int(rv_param)
+            if rv_param and rv_param != '0' and rv < oldest - 1:
+                send({'type': 'ERROR', 'object': self._status(410, 'Expired', 'too old resource version')})
+            else:
+                for obj in initial:
+                    send({'type': 'ADDED', 'object': obj})
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    with self.cluster.cond:
+                        events = []
+                        for e in reversed(self.cluster.history):
+                            if e[0] <= rv:
+                                break
+                            events.append(e)
+                        events.reverse()
+                        if not events:
+                            self.cluster.cond.wait(min(remaining, 1.0))
+                            continue
+                    rv = events[-1][0]
+                    for _, event_res, event_type, obj in events:
+                        if event_res == res and matches(obj):
+                            send({'type': event_type, 'object': obj})
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def start_server(cluster: FakeCluster, port: int = 0) -> ThreadingHTTPServer:
+    """API サーバをバックグラウンドのスレッドで起動する。port に 0 を指定すると空きポートを使用する。"""
+    handler = type('BoundHandler', (Handler,), {'cluster': cluster})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_kubeconfig(path: str, port: int) -> None:
+    """fake API サーバに接続するための kubeconfig を書き出す。"""
+    with open(path, 'w') as f:
+        json.dump({
+            'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+            'clusters': [{'name': 'fake', 'cluster': {'server': 'http://127.0.0.1:%d' % port}}],
+            'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake', 'namespace': 'onap'}}],
+        }, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fake kubernetes API server for benchmarks')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--ready-delay', type=float, default=1.0, help='seconds until a workload becomes ready')
+    parser.add_argument('--terminate-delay', type=float, default=0.5, help='seconds until scaled-down pods are gone')
+    args = parser.parse_args()
+    srv = start_server(FakeCluster(args.ready_delay, args.terminate_delay), args.port)
+    print('fake API server listening on http://127.0.0.1:%d' % srv.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
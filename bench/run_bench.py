@@ -0,0 +1,199 @@
+# ---------------------------------------------------------------------------
+# run_bench.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+#
+# fake Kubernetes API サーバ (fakeapi.py) と fake helm (bin/helm) を使って
+# deploy.py と startstop.py の性能を測定する。実行例:
+#
+#   python bench/run_bench.py --sizes 100,300 --json bench-result.json
+#
+# シナリオごとに経過時間、API リクエスト数、子プロセスのピークメモリを出力する。
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import yaml
+
+import fakeapi
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEPLOY_PY = os.path.join(REPO_DIR, 'startstop', 'deploy.py')
+STARTSTOP_PY = os.path.join(REPO_DIR, 'startstop', 'startstop.py')
+SAMPLE_DESCRIPTOR = os.path.join(REPO_DIR, 'startstop', 'deploydesc.yaml')
+
+# 1 シナリオあたりの制限時間 (秒)
+SCENARIO_TIMEOUT = 1800
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='offline benchmark for deploy.py and startstop.py')
+    parser.add_argument('--sizes', default='100,300',
+                        help='comma separated numbers of subcharts for synthetic descriptors (default: 100,300)')
+    parser.add_argument('--stage-width', type=int, default=20, help='subcharts per stage in synthetic descriptors')
+    parser.add_argument('--workloads', default='200,1000',
+                        help='comma separated numbers of workloads for startstop scenarios (default: 200,1000)')
+    parser.add_argument('--ready-delay', type=float, default=1.0, help='seconds until a workload becomes ready')
+    parser.add_argument('--terminate-delay', type=float, default=0.5, help='seconds until scaled-down pods are gone')
+    parser.add_argument('--helm-latency', type=float, default=0.5, help='seconds per fake helm deploy')
+    parser.add_argument('--deployments', type=int, default=2, help='deployments per subchart release')
+    parser.add_argument('--statefulsets', type=int, default=1, help='statefulsets per subchart release')
+    parser.add_argument('--only', choices=['deploy', 'startstop'], help='run only one group of scenarios')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON to this file')
+    return parser.parse_args()
+
+
+def synthetic_descriptor(subcharts: int, width: int) -> dict:
+    """subcharts 個の subchart を width 個ずつのステージに並べたデプロイ定義を返す。"""
+    names = ['sub%03d' % i for i in range(subcharts)]
+    return {'namespace': 'onap', 'release_name': 'dev', 'base_override': 'override.yaml', 'readiness_timeout': 600,
+            'master_password': 'pw', 'deploy_order': [names[i:i + width] for i in range(0, len(names), width)]}
+
+
+def run_measured(cmd: list, cwd: str, env: dict) -> tuple:
+    """コマンドを実行し、(終了コード, 経過秒数, ピーク RSS [MiB]) を返す。"""
+    start = time.monotonic()
+    with open(os.path.join(cwd, 'output.txt'), 'ab') as out:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=out, stderr=subprocess.STDOUT)
+        deadline = start + SCENARIO_TIMEOUT
+        while True:
+            # os.wait4 でこのプロセス自身のリソース使用量を取得する
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                proc.kill()
+            time.sleep(0.05)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # Linux の ru_maxrss は KiB 単位
+    return proc.returncode, time.monotonic() - start, rusage.ru_maxrss / 1024
+
+
+class Scenario:
+    """fake API サーバを起動し、その上で 1 つのシナリオを実行する。"""
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.cluster = fakeapi.FakeCluster(args.ready_delay, args.terminate_delay)
+        self.server = fakeapi.start_server(self.cluster)
+        self.port = self.server.server_address[1]
+        self.tmp = tempfile.TemporaryDirectory(prefix='onap-bench-')
+        self.kubeconfig = os.path.join(self.tmp.name, 'kubeconfig')
+        fakeapi.write_kubeconfig(self.kubeconfig, self.port)
+        self.env = dict(os.environ,
+                        PATH=os.path.join(BENCH_DIR, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+                        FAKE_KUBE_URL='http://127.0.0.1:%d' % self.port,
+                        FAKE_HELM_LATENCY=str(args.helm_latency),
+                        FAKE_HELM_DEPLOYMENTS=str(args.deployments),
+                        FAKE_HELM_STATEFULSETS=str(args.statefulsets))
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.tmp.cleanup()
+
+    def post(self, path: str, body: dict) -> None:
+        req = urllib.request.Request('http://127.0.0.1:%d%s' % (self.port, path), data=json.dumps(body).encode(),
+                                     method='POST', headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(req).read()
+
+    def run(self, name: str, cmd: list, size: int) -> dict:
+        self.post('/fake/reset', {})
+        code, elapsed, peak = run_measured(cmd, self.tmp.name, self.env)
+        stats = self.cluster.stats()
+        result = {'scenario': name, 'size': size, 'exit_code': code, 'seconds': round(elapsed, 2),
+                  'api_requests': stats['total'], 'requests': stats['requests'], 'peak_rss_mib': round(peak, 1)}
+        if code != 0:
+            with open(os.path.join(self.tmp.name, 'output.txt'), errors='replace') as f:
+                result['output_tail'] = f.read()[-2000:]
+        return result
+
+
+def bench_deploy(args: argparse.Namespace, name: str, descriptor: dict) -> dict:
+    scenario = Scenario(args)
+    try:
+        with open(os.path.join(scenario.tmp.name, 'override.yaml'), 'w') as f:
+            f.write('global: {}\n')
+        descriptor = dict(descriptor, base_override=os.path.join(scenario.tmp.name, 'override.yaml'))
+        desc_path = os.path.join(scenario.tmp.name, 'deploydesc.yaml')
+        with open(desc_path, 'w') as f:
+            yaml.safe_dump(descriptor, f)
+        size = len({s for stage in descriptor.get('deploy_order', []) for s in stage})
+        return scenario.run(name, [sys.executable, DEPLOY_PY, '-d', desc_path, '-c', scenario.kubeconfig], size)
+    finally:
+        scenario.close()
+
+
+def bench_skip_deploy(args: argparse.Namespace, workloads: int) -> dict:
+    """--skip-deploy で Ready 待ちだけを行う。override ファイルが無くても終了コード 0 で終わること。"""
+    scenario = Scenario(args)
+    try:
+        scenario.post('/fake/seed', {'namespace': 'onap', 'release': 'dev-bench',
+                                     'deployments': workloads - workloads // 2, 'statefulsets': workloads // 2})
+        return scenario.run('deploy-skip-deploy', [sys.executable, DEPLOY_PY, '--skip-deploy', '-r', 'dev', '-c',
+                                                   scenario.kubeconfig, 'bench'], workloads)
+    finally:
+        scenario.close()
+
+
+def bench_startstop(args: argparse.Namespace, workloads: int) -> list:
+    scenario = Scenario(args)
+    try:
+        scenario.post('/fake/seed', {'namespace': 'onap', 'release': 'dev-bench',
+                                     'deployments': workloads - workloads // 2, 'statefulsets': workloads // 2})
+        state = os.path.join(scenario.tmp.name, 'last-state')
+        results = []
+        for action in ['stop', 'start']:
+            results.append(scenario.run('startstop-%s' % action,
+                                        [sys.executable, STARTSTOP_PY, action, '-s', state, '-c', scenario.kubeconfig],
+                                        workloads))
+        # デプロイ定義のウェーブ順の起動。全て Ready になった場合は終了コード 0 で終わること
+        desc_path = os.path.join(scenario.tmp.name, 'deploydesc.yaml')
+        with open(desc_path, 'w') as f:
+            yaml.safe_dump(dict(synthetic_descriptor(0, 1), release_name='dev', deploy_order=[['bench'], ['other']]),
+                           f)
+        for name, cmd in [('startstop-stop', ['stop']), ('startstop-start-waves', ['start', '-d', desc_path])]:
+            results.append(scenario.run(name, [sys.executable, STARTSTOP_PY] + cmd +
+                                        ['-s', state, '-c', scenario.kubeconfig], workloads))
+        return results
+    finally:
+        scenario.close()
+
+
+def print_table(results: list) -> None:
+    print('%-22s %6s %5s %9s %9s %9s' % ('SCENARIO', 'SIZE', 'EXIT', 'SECONDS', 'REQUESTS', 'PEAK MiB'))
+    for r in results:
+        print('%-22s %6d %5d %9.2f %9d %9.1f' % (r['scenario'], r['size'], r['exit_code'], r['seconds'],
+                                                  r['api_requests'], r['peak_rss_mib']))
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    results = []
+    if args.only in (None, 'deploy'):
+        with open(SAMPLE_DESCRIPTOR) as f:
+            results.append(bench_deploy(args, 'deploy-sample', yaml.safe_load(f)))
+        for size in [int(x) for x in args.sizes.split(',') if x]:
+            results.append(bench_deploy(args, 'deploy-synthetic', synthetic_descriptor(size, args.stage_width)))
+        results.append(bench_skip_deploy(args, 2 * (args.deployments + args.statefulsets)))
+    if args.only in (None, 'startstop'):
+        for workloads in [int(x) for x in args.workloads.split(',') if x]:
+            results.extend(bench_startstop(args, workloads))
+
+    print_table(results)
+    for r in results:
+        if r['exit_code'] != 0:
+            print('--- %s (size=%d) failed. last output:\n%s' % (r['scenario'], r['size'], r.get('output_tail', '')))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parameters': vars(args), 'results': results}, f, indent=2)
+    sys.exit(1 if any(r['exit_code'] != 0 for r in results) else 0)
@@ -1,47 +1,605 @@
-import json
-import sys
+import argparse
+import concurrent.futures
 import csv
+import datetime
+import functools
+import io
+import json
+import mmap
 import os
-import dateutil.parser
+import re
+import sqlite3
+import sys
+import time
 
-if __name__ == '__main__':
-    if len(sys.argv) <= 2:
-        print('error: no filename specified.')
-        print('usage: %s <input file> <output file>' % sys.argv[0])
-        sys.exit(1)
-    if os.path.exists(sys.argv[2]):
-        print('file %s already exists. overwrite? (y/n)' % (sys.argv[2],))
-        answer = sys.stdin.readline().strip()
-        if answer not in ['y', 'Y', 'yes', 'Yes', 'YES']:
-            print('aborted.')
-            sys.exit(2)
-    with open(sys.argv[1], 'r') as f, open(sys.argv[2], 'w', newline="") as outf:
+# Use orjson if it is installed. It decodes event lines several times faster than the json module.
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+HEADER = ['Namespace', 'Kind', 'Name', 'Reason', 'Message', 'FirstTimestamp', 'LastTimestamp', 'TimeDiff', 'Count']
+
+# Event reasons tracked per pod in timeline mode. 'ReadinessFailed' is an Unhealthy event of a readiness probe.
+PHASES = ['Scheduled', 'Pulling', 'Pulled', 'Created', 'Started', 'ReadinessFailed', 'BackOff']
+
+TIMELINE_HEADER = ['Namespace', 'Pod', 'Component', 'Scheduled', 'PullSeconds', 'StartSeconds', 'ProbeWaitSeconds',
+                   'TotalSeconds', 'ReadinessFailures', 'BackOffs']
+
+# Pod name suffixes added by controllers: '-<ordinal>' (StatefulSet), '-<hash>-<id>' (Deployment), '-<id>' (Job).
+# Random parts use the kubernetes "safe" alphabet, which has no vowels.
+STATEFULSET_SUFFIX = re.compile(r'-\d+$')
+POD_ID_SUFFIX = re.compile(r'-[bcdfghjklmnpqrstvwxz2456789]{5}$')
+TEMPLATE_HASH_SUFFIX = re.compile(r'-[bcdfghjklmnpqrstvwxz2456789]{6,10}$')
+
+# Table and indexes of the sqlite mode. Timestamps are RFC3339 strings in UTC, so they can be compared as text.
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS events (namespace TEXT, kind TEXT, name TEXT, reason TEXT, message TEXT,
+                           first_timestamp TEXT, last_timestamp TEXT, time_diff REAL, count INTEGER)""",
+]
+SQLITE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS events_namespace ON events (namespace)',
+    'CREATE INDEX IF NOT EXISTS events_kind ON events (kind)',
+    'CREATE INDEX IF NOT EXISTS events_name ON events (name)',
+    'CREATE INDEX IF NOT EXISTS events_reason ON events (reason)',
+    'CREATE INDEX IF NOT EXISTS events_last_timestamp ON events (last_timestamp)',
+]
+
+# Input is split into chunks of about this size (bytes) and processed by worker processes
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Interval (seconds) to check the input for new events in follow mode
+FOLLOW_INTERVAL = 2
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='convert kubernetes-event-exporter JSON lines to CSV.')
+    parser.add_argument('input', help='event log file written by kubernetes-event-exporter')
+    parser.add_argument('output', help='CSV file (or sqlite database file for sqlite mode) to write')
+    parser.add_argument('--mode', choices=['csv', 'timeline', 'sqlite'], default='csv',
+                        help='csv: one row per event. timeline: one row per pod with the time spent in each phase '
+                             'and a per-component summary. sqlite: events table with indexes (default: csv)')
+    parser.add_argument('--summary', metavar='FILE',
+                        help='timeline mode: also write the per-component summary to this CSV file')
+    parser.add_argument('--yes', '-y', action='store_true', help='overwrite the output file without asking')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, metavar='BYTES',
+                        help='bytes of input given to a worker at once (default: %d)' % CHUNK_SIZE)
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='csv/sqlite mode: remember the processed byte offset in this file, and on the next run '
+                             'append only the events added since then (default with --follow: <output>.checkpoint)')
+    parser.add_argument('--follow', '-f', action='store_true',
+                        help='csv/sqlite mode: keep reading events appended to the input, following log rotation')
+    parser.add_argument('--interval', type=float, default=FOLLOW_INTERVAL, metavar='SECONDS',
+                        help='follow mode: seconds between checks for new events (default: %d)' % FOLLOW_INTERVAL)
+    return parser.parse_args()
+
+
+# parse_time
+# params:
+#   s ... RFC3339 timestamp such as '2021-05-10T08:12:34Z'
+# return:
+#   timezone-aware datetime
+# Events in a burst share the same timestamp, so parsed values are cached.
+@functools.lru_cache(maxsize=65536)
+def parse_time(s):
+    try:
+        if s.endswith('Z'):
+            return datetime.datetime.fromisoformat(s[:-1] + '+00:00')
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        # Formats fromisoformat does not handle (e.g. fractions other than 3 or 6 digits)
+        import dateutil.parser
+        return dateutil.parser.isoparse(s)
+
+
+# chunk_ranges
+# params:
+#   buf ... mmap of the input file
+#   chunk_size ... approximate bytes per chunk
+# return:
+#   list of (start, end) byte offsets. Each chunk ends just after a newline.
+def chunk_ranges(buf, chunk_size):
+    ranges = []
+    start = 0
+    while start < len(buf):
+        end = buf.find(b'\n', min(start + chunk_size, len(buf)) - 1)
+        end = len(buf) if end < 0 else end + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+# first_timestamp
+# return:
+#   lastTimestamp of the first valid event, which is the origin of TimeDiff
+def first_timestamp(buf):
+    for line in iter(buf.readline, b''):
+        if not line.strip():
+            continue
+        try:
+            obj = loads(line)
+        except ValueError:
+            continue
+        if obj['lastTimestamp']:
+            return obj['lastTimestamp']
+    return None
+
+
+# read_chunk
+# params:
+#   path ... input file
+#   start, end ... byte range of the chunk
+# return:
+#   generator of (line number in the chunk, line)
+def read_chunk(path, start, end):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        buf.seek(start)
         linenum = 0
-        csvout = csv.writer(outf)
-        startTime = None
-        # Write a header
-        csvout.writerow(
-            ['Namespace', 'Kind', 'Name', 'Reason', 'Message', 'FirstTimestamp', 'LastTimestamp', 'TimeDiff', 'Count'])
-        for line in f:
+        while buf.tell() < end:
             linenum = linenum + 1
+            yield linenum, buf.readline()
+
+
+# convert_chunk
+# params:
+#   path ... input file
+#   start, end ... byte range of the chunk
+#   origin ... lastTimestamp of the first event
+# return:
+#   (CSV text, number of lines, list of (line number in the chunk, error message))
+def convert_chunk(path, start, end, origin):
+    out = io.StringIO()
+    csvout = csv.writer(out)
+    start_time = parse_time(origin) if origin else None
+    warnings = []
+    linenum = 0
+    for linenum, line in read_chunk(path, start, end):
+        try:
+            if not line.strip():
+                # Skip empty line
+                continue
+            row = event_row(loads(line), start_time)
+            row[7] = str(row[7])
+            csvout.writerow(row)
+        except ValueError as e:
+            warnings.append((linenum, str(e)))
+    return out.getvalue(), linenum, warnings
+
+
+# event_row
+# return:
+#   list of HEADER values for an event. TimeDiff is a timedelta.
+def event_row(obj, start_time):
+    involved = obj['involvedObject']
+    return [
+        involved.get('namespace', '---'),
+        involved.get('kind', '---'),
+        involved.get('name', '---'),
+        obj['reason'],
+        obj['message'],
+        obj['firstTimestamp'],
+        obj['lastTimestamp'],
+        parse_time(obj['lastTimestamp']) - start_time,
+        obj['count']
+    ]
+
+
+# rows_chunk
+# return:
+#   (list of rows for the events table, number of lines, warnings)
+def rows_chunk(path, start, end, origin):
+    start_time = parse_time(origin) if origin else None
+    rows = []
+    warnings = []
+    linenum = 0
+    for linenum, line in read_chunk(path, start, end):
+        try:
+            if not line.strip():
+                continue
+            row = event_row(loads(line), start_time)
+            row[7] = row[7].total_seconds()
+            rows.append(row)
+        except ValueError as e:
+            warnings.append((linenum, str(e)))
+    return rows, linenum, warnings
+
+
+# phase_of
+# return:
+#   name in PHASES for the event, or None if the event is not tracked
+def phase_of(obj):
+    reason = obj.get('reason')
+    if reason == 'Unhealthy':
+        return 'ReadinessFailed' if (obj.get('message') or '').startswith('Readiness probe failed') else None
+    return reason if reason in PHASES else None
+
+
+# timeline_chunk
+# return:
+#   ({(namespace, pod): {phase: [first time, last time, {event: count}]}}, number of lines, warnings)
+# Only the first/last time and the count of each event per phase are kept, so results of chunks can be merged
+# in any order.
+def timeline_chunk(path, start, end):
+    index = {}
+    warnings = []
+    linenum = 0
+    for linenum, line in read_chunk(path, start, end):
+        try:
+            if not line.strip():
+                continue
+            add_event(index, loads(line))
+        except ValueError as e:
+            warnings.append((linenum, str(e)))
+    return index, linenum, warnings
+
+
+# add_event
+# Records a pod event in the timeline index. Events not in PHASES are ignored.
+def add_event(index, obj):
+    involved = obj['involvedObject']
+    phase = phase_of(obj)
+    if involved.get('kind') != 'Pod' or phase is None:
+        return
+    first = obj.get('firstTimestamp') or obj.get('eventTime') or obj.get('lastTimestamp')
+    last = obj.get('lastTimestamp') or first
+    if not first:
+        return
+    # An event is logged again with an increased count each time it recurs, so the counts are kept per event
+    metadata = obj.get('metadata') or {}
+    event = metadata.get('uid') or '%s/%s' % (metadata.get('name'), first)
+    merge_phase(index.setdefault((involved.get('namespace', '---'), involved.get('name', '---')), {}),
+                phase, [parse_time(first), parse_time(last), {event: obj.get('count') or 1}])
+
+
+def merge_phase(phases, phase, value):
+    current = phases.get(phase)
+    if current is None:
+        phases[phase] = value
+    else:
+        counts = current[2]
+        for event, count in value[2].items():
+            counts[event] = max(counts.get(event, 0), count)
+        phases[phase] = [min(current[0], value[0]), max(current[1], value[1]), counts]
+
+
+# pod_component
+# return:
+#   workload name of the pod, e.g. 'dev-sdc-be' for 'dev-sdc-be-7d9c8b6f4-x2x9q'
+def pod_component(name):
+    if STATEFULSET_SUFFIX.search(name):
+        return STATEFULSET_SUFFIX.sub('', name)
+    if POD_ID_SUFFIX.search(name):
+        return TEMPLATE_HASH_SUFFIX.sub('', POD_ID_SUFFIX.sub('', name))
+    return name
+
+
+def seconds_between(phases, first, last, first_index=0, last_index=1):
+    if first not in phases or last not in phases:
+        return None
+    return max(0.0, (phases[last][last_index] - phases[first][first_index]).total_seconds())
+
+
+# pod_summary
+# return:
+#   row of TIMELINE_HEADER for a pod
+def pod_summary(namespace, pod, phases):
+    begin = phases['Scheduled'][0] if 'Scheduled' in phases else min(v[0] for v in phases.values())
+    end = max(v[1] for v in phases.values())
+    probe_wait = seconds_between(phases, 'Started', 'ReadinessFailed') if 'ReadinessFailed' in phases else 0.0
+    return [namespace, pod, pod_component(pod), begin.isoformat(),
+            seconds_between(phases, 'Pulling', 'Pulled'),
+            seconds_between(phases, 'Created', 'Started'),
+            probe_wait,
+            (end - begin).total_seconds(),
+            sum(phases.get('ReadinessFailed', [None, None, {}])[2].values()),
+            sum(phases.get('BackOff', [None, None, {}])[2].values())]
+
+
+# component_summary
+# return:
+#   rows of (component, pods, average and max seconds of each duration column), slowest component first
+def component_summary(rows):
+    columns = ['PullSeconds', 'StartSeconds', 'ProbeWaitSeconds', 'TotalSeconds']
+    indexes = [TIMELINE_HEADER.index(c) for c in columns]
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[2], []).append(row)
+    summary = []
+    for component, members in groups.items():
+        values = [len(members)]
+        for i in indexes:
+            durations = [r[i] for r in members if r[i] is not None]
+            values += [round(sum(durations) / len(durations), 1) if durations else None,
+                       max(durations) if durations else None]
+        summary.append([component] + values)
+    summary.sort(key=lambda r: -(r[-1] or 0))
+    header = ['Component', 'Pods'] + [p + c for c in columns for p in ['Avg', 'Max']]
+    return header, summary
+
+
+# process_chunks
+# params:
+#   func ... function called as func(path, start, end, *func_args) for each chunk, returning
+#            (result, number of lines, warnings)
+#   consume ... function called with the result of each chunk, in input order
+# Chunks are processed in parallel but consumed in input order, and at most 2 chunks per worker are in flight
+# so memory use does not depend on the input size.
+def process_chunks(path, jobs, chunk_size, func, func_args, consume):
+    if os.path.getsize(path) == 0:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        ranges = chunk_ranges(buf, chunk_size)
+
+    def handle(chunk_result, linenum):
+        result, lines, warnings = chunk_result
+        consume(result)
+        for n, e in warnings:
+            print('warn: ignoring invalid json at line %d. (error=%s)' % (linenum + n, e))
+        return linenum + lines
+
+    linenum = 0
+    if jobs <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            linenum = handle(func(path, start, end, *func_args), linenum)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        for start, end in ranges:
+            pending.append(executor.submit(func, path, start, end, *func_args))
+            if len(pending) >= jobs * 2:
+                linenum = handle(pending.pop(0).result(), linenum)
+        for future in pending:
+            linenum = handle(future.result(), linenum)
+
+
+# origin_of
+# return:
+#   lastTimestamp of the first event in the file
+def origin_of(path):
+    if os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return first_timestamp(buf)
+
+
+# convert
+# Writes one CSV row per event.
+def convert(path, outf, jobs, chunk_size):
+    origin = origin_of(path)
+    csvout = csv.writer(outf)
+    # Write a header
+    csvout.writerow(HEADER)
+    process_chunks(path, jobs, chunk_size, convert_chunk, (origin,), outf.write)
+
+
+# timeline
+# Writes one row per pod with the time spent in each phase, and returns the per-component summary.
+# The index holds only a few timestamps per pod, so its size depends on the number of pods, not events.
+def timeline(path, outf, jobs, chunk_size):
+    index = {}
+
+    def merge(chunk_index):
+        for key, phases in chunk_index.items():
+            merged = index.setdefault(key, {})
+            for phase, value in phases.items():
+                merge_phase(merged, phase, value)
+
+    process_chunks(path, jobs, chunk_size, timeline_chunk, (), merge)
+    return write_timeline(index, outf)
+
+
+# write_timeline
+# Writes the timeline index as one row per pod, and returns the per-component summary.
+def write_timeline(index, outf):
+    rows = [pod_summary(ns, pod, phases) for (ns, pod), phases in index.items()]
+    rows.sort(key=lambda r: r[3])
+    csvout = csv.writer(outf)
+    csvout.writerow(TIMELINE_HEADER)
+    csvout.writerows(rows)
+    return component_summary(rows)
+
+
+# load_sqlite
+# Loads events into the events table of a new sqlite database. Rows of a chunk are inserted in one transaction,
+# and indexes are built after all rows are loaded.
+def load_sqlite(path, db_path, jobs, chunk_size):
+    db = sqlite3.connect(db_path)
+    try:
+        # The database can be rebuilt from the input, so durability is traded for load speed
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        for statement in SQLITE_SCHEMA:
+            db.execute(statement)
+
+        def insert(rows):
+            with db:
+                db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        process_chunks(path, jobs, chunk_size, rows_chunk, (origin_of(path),), insert)
+        with db:
+            for statement in SQLITE_INDEXES:
+                db.execute(statement)
+        db.execute('ANALYZE')
+    finally:
+        db.close()
+
+
+# load_checkpoint
+# return:
+#   {'inode': ..., 'offset': ..., 'line': ..., 'origin': ...} saved by save_checkpoint, or None
+def load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint_path, state):
+    # Write to a temporary file and rename it, so an interrupted write does not break the checkpoint
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+# follow
+# params:
+#   sink ... function called with the rows (lists of HEADER values) of each batch of new events
+#   state ... checkpoint to resume from, or None to start from the beginning of the input
+# Reads complete lines appended to the input after the checkpoint. When the input is rotated (replaced by a new
+# file) the rest of the old file is read first, and when it is truncated reading restarts from its beginning.
+# The checkpoint is saved after each batch is written.
+def follow(path, sink, checkpoint_path, state, keep_following, interval):
+    f = open(path, 'rb')
+    inode = os.fstat(f.fileno()).st_ino
+    if state and state['inode'] == inode and state['offset'] <= os.fstat(f.fileno()).st_size:
+        offset, linenum, origin = state['offset'], state['line'], state['origin']
+        print('info: resuming %s from byte %d (line %d)' % (path, offset, linenum))
+    else:
+        if state:
+            print('info: %s was rotated or truncated. reading from the beginning.' % path)
+        offset, linenum, origin = 0, 0, state['origin'] if state else None
+    try:
+        while True:
+            f.seek(offset)
+            data = f.read(CHUNK_SIZE)
+            end = data.rfind(b'\n')
+            if end >= 0:
+                rows = []
+                for line in data[:end + 1].splitlines():
+                    linenum = linenum + 1
+                    try:
+                        if not line.strip():
+                            continue
+                        obj = loads(line)
+                        if origin is None and obj['lastTimestamp']:
+                            origin = obj['lastTimestamp']
+                        rows.append(event_row(obj, parse_time(origin) if origin else None))
+                    except ValueError as e:
+                        print('warn: ignoring invalid json at line %d. (error=%s)' % (linenum, e))
+                sink(rows)
+                offset = offset + end + 1
+                save_checkpoint(checkpoint_path, {'inode': inode, 'offset': offset, 'line': linenum, 'origin': origin})
+                continue
+            if not keep_following:
+                break
+            # No complete line is left. Check whether the input was rotated or truncated.
             try:
-                if not line.strip():
-                    # Skip empty line
-                    continue
-                obj = json.loads(line)
-                if startTime is None and obj['lastTimestamp']:
-                    startTime = dateutil.parser.isoparse(obj['lastTimestamp'])
-                csvout.writerow([
-                    obj['involvedObject'].get('namespace', '---'),
-                    obj['involvedObject'].get('kind', '---'),
-                    obj['involvedObject'].get('name', '---'),
-                    obj['reason'],
-                    obj['message'],
-                    obj['firstTimestamp'],
-                    obj['lastTimestamp'],
-                    str(dateutil.parser.isoparse(obj['lastTimestamp']) - startTime),
-                    obj['count']
-                ])
-            except ValueError as e:
-                print('warn: ignoring invalid json at line %d. (error=%s)' % (linenum, e))
+                current = os.stat(path)
+            except FileNotFoundError:
+                time.sleep(interval)
+                continue
+            if current.st_ino != inode:
+                print('info: %s was rotated. continuing with the new file.' % path)
+                f.close()
+                f = open(path, 'rb')
+                inode, offset, linenum = os.fstat(f.fileno()).st_ino, 0, 0
+            elif current.st_size < offset:
+                print('info: %s was truncated. reading from the beginning.' % path)
+                offset, linenum = 0, 0
+            else:
+                time.sleep(interval)
+    finally:
+        f.close()
+
+
+# open_sink
+# params:
+#   new ... True to start a new output, False to append to the output of a previous run
+# return:
+#   (function called with rows (lists of HEADER values) to append, function to close the output)
+def open_sink(mode, output, new):
+    if new and os.path.exists(output):
+        os.remove(output)
+    if mode == 'sqlite':
+        db = sqlite3.connect(output)
+        for statement in SQLITE_SCHEMA + SQLITE_INDEXES:
+            db.execute(statement)
+
+        def sink(rows):
+            for row in rows:
+                row[7] = row[7].total_seconds()
+            with db:
+                db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return sink, db.close
+
+    outf = open(output, 'a', newline="")
+    csvout = csv.writer(outf)
+    if new:
+        # Write a header
+        csvout.writerow(HEADER)
+
+    def sink(rows):
+        for row in rows:
+            row[7] = str(row[7])
+        csvout.writerows(rows)
+        outf.flush()
+    return sink, outf.close
+
+
+# append_events
+# Appends events added to the input since the checkpoint to the CSV file or sqlite database.
+def append_events(args, checkpoint_path):
+    state = load_checkpoint(checkpoint_path) if os.path.exists(args.output) else None
+    sink, close = open_sink(args.mode, args.output, state is None)
+    try:
+        follow(args.input, sink, checkpoint_path, state, args.follow, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close()
+
+
+def confirm_overwrite(path):
+    print('file %s already exists. overwrite? (y/n)' % (path,))
+    answer = sys.stdin.readline().strip()
+    if answer not in ['y', 'Y', 'yes', 'Yes', 'YES']:
+        print('aborted.')
+        sys.exit(2)
+
+
+def print_summary(header, rows, count=20):
+    names = header[:2] + [h.replace('Seconds', '') for h in header[2:]]
+    print(('%-36s %5s' + ' %12s' * (len(header) - 2)) % tuple(names))
+    for row in rows[:count]:
+        print(('%-36s %5d' + ' %12s' * (len(row) - 2)) % tuple(row[:2] + ['-' if v is None else v for v in row[2:]]))
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    checkpoint_path = args.checkpoint or (args.output + '.checkpoint' if args.follow else None)
+    if checkpoint_path:
+        if args.mode == 'timeline':
+            print('error: --checkpoint and --follow cannot be used with timeline mode.')
+            sys.exit(1)
+        # Appending to the output of the previous run does not need a confirmation
+        resuming = os.path.exists(args.output) and load_checkpoint(checkpoint_path) is not None
+        if os.path.exists(args.output) and not resuming and not args.yes:
+            confirm_overwrite(args.output)
+        append_events(args, checkpoint_path)
+        sys.exit(0)
+    if os.path.exists(args.output) and not args.yes:
+        confirm_overwrite(args.output)
+    if args.mode == 'sqlite':
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        load_sqlite(args.input, args.output, args.jobs, args.chunk_size)
+        sys.exit(0)
+    with open(args.output, 'w', newline="") as outf:
+        if args.mode == 'timeline':
+            header, summary = timeline(args.input, outf, args.jobs, args.chunk_size)
+        else:
+            convert(args.input, outf, args.jobs, args.chunk_size)
+    if args.mode == 'timeline':
+        print_summary(header, summary)
+        if args.summary:
+            with open(args.summary, 'w', newline="") as f:
+                csvout = csv.writer(f)
+                csvout.writerow(header)
+                csvout.writerows(summary)
     sys.exit(0)
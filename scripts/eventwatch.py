@@ -0,0 +1,219 @@
+import argparse
+import collections
+import csv
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+
+import events2csv
+
+# Max number of events waiting to be written. The watch waits when the writer falls behind.
+QUEUE_SIZE = 10000
+
+# Max number of event UIDs remembered for deduplication. The oldest ones are forgotten first.
+SEEN_SIZE = 100000
+
+# Seconds of one watch request. After that the watch is resumed from the last resourceVersion.
+WATCH_TIMEOUT = 300
+
+# Seconds to wait before retrying after an API error
+RETRY_INTERVAL = 5
+
+# Max number of events written in one batch (one transaction for sqlite)
+BATCH_SIZE = 500
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='collect kubernetes events from the API server '
+                                                 'into CSV, sqlite or timeline output.')
+    parser.add_argument('output', help='CSV file (or sqlite database file for sqlite mode) to write')
+    parser.add_argument('--mode', choices=['csv', 'timeline', 'sqlite'], default='csv',
+                        help='output format. same as events2csv.py (default: csv)')
+    parser.add_argument('--summary', metavar='FILE',
+                        help='timeline mode: also write the per-component summary to this CSV file')
+    parser.add_argument('--config', '-c', help='kubeconfig file (default: $KUBECONFIG or ~/.kube/config)')
+    parser.add_argument('--namespace', '-n', help='namespace to watch (default: all namespaces)')
+    parser.add_argument('--existing', action='store_true',
+                        help='also write the events that exist when the collector starts')
+    parser.add_argument('--append', '-a', action='store_true',
+                        help='csv/sqlite mode: append to the output instead of overwriting it')
+    parser.add_argument('--duration', type=float, metavar='SECONDS', help='stop after this many seconds')
+    return parser.parse_args()
+
+
+# rfc3339
+# return:
+#   timestamp in the form kubernetes-event-exporter writes, e.g. '2021-05-10T08:12:34Z'
+def rfc3339(value):
+    if value and value.endswith('+00:00'):
+        return value[:-6] + 'Z'
+    return value
+
+
+# normalize
+# params:
+#   obj ... event as a dict in the API (camelCase) form
+# Events created through events.k8s.io/v1 have eventTime and series instead of the timestamps and count.
+# They are copied to the fields events2csv.py reads.
+def normalize(obj):
+    series = obj.get('series') or {}
+    obj['firstTimestamp'] = rfc3339(obj.get('firstTimestamp') or obj.get('eventTime'))
+    obj['lastTimestamp'] = rfc3339(obj.get('lastTimestamp') or series.get('lastObservedTime')) or obj['firstTimestamp']
+    obj['count'] = obj.get('count') or series.get('count') or 1
+    obj['message'] = obj.get('message') or ''
+    return obj
+
+
+class EventCollector:
+    """Watches events and puts each new occurrence into a bounded queue.
+
+    An event object is updated in place when it occurs again, so updates are deduplicated by the UID and count.
+    """
+    def __init__(self, api, namespace, existing):
+        self.api = api
+        self.namespace = namespace
+        self.existing = existing
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self._seen = collections.OrderedDict()
+        self._watch = None
+
+    def _list_func(self):
+        if self.namespace:
+            return self.api.list_namespaced_event, (self.namespace,)
+        return self.api.list_event_for_all_namespaces, ()
+
+    # _offer
+    # params:
+    #   event ... V1Event
+    #   emit ... False to only remember the event as already seen
+    def _offer(self, event, emit=True):
+        obj = normalize(self.api.api_client.sanitize_for_serialization(event))
+        uid = obj['metadata'].get('uid')
+        if self._seen.get(uid) == obj['count']:
+            return
+        self._seen[uid] = obj['count']
+        self._seen.move_to_end(uid)
+        if len(self._seen) > SEEN_SIZE:
+            self._seen.popitem(last=False)
+        while emit and not self.stopped.is_set():
+            try:
+                self.queue.put(obj, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        list_func, list_args = self._list_func()
+        first_list = True
+        while not self.stopped.is_set():
+            try:
+                resp = list_func(*list_args)
+                for event in resp.items:
+                    # After a relist, events missed while the watch was down are written here
+                    self._offer(event, self.existing or not first_list)
+                first_list = False
+                resource_version = resp.metadata.resource_version
+                while not self.stopped.is_set():
+                    self._watch = watch.Watch()
+                    expired = False
+                    for item in self._watch.stream(list_func, *list_args, resource_version=resource_version,
+                                                   timeout_seconds=WATCH_TIMEOUT, allow_watch_bookmarks=True):
+                        if item['type'] == 'ERROR':
+                            # 410 Gone etc. List the events again.
+                            expired = True
+                            break
+                        if item['type'] in ('ADDED', 'MODIFIED'):
+                            self._offer(item['object'])
+                    self._watch.stop()
+                    if expired:
+                        break
+                    resource_version = self._watch.resource_version or resource_version
+            except ApiException as e:
+                if e.status != 410:
+                    print('warn: API error while watching events (%s). retrying in %d seconds'
+                          % (e.reason, RETRY_INTERVAL))
+                    self.stopped.wait(RETRY_INTERVAL)
+            except Exception as e:
+                if self.stopped.is_set():
+                    break
+                print('warn: watching events failed (%s). retrying in %d seconds' % (e, RETRY_INTERVAL))
+                self.stopped.wait(RETRY_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+
+# write_events
+# Takes events from the collector's queue and writes them in batches until the collector is stopped.
+# return:
+#   number of events written
+def write_events(collector, args):
+    index = {}
+    origin = None
+    sink = close = None
+    if args.mode != 'timeline':
+        sink, close = events2csv.open_sink(args.mode, args.output, not (args.append and os.path.exists(args.output)))
+    written = 0
+    try:
+        while not (collector.stopped.is_set() and collector.queue.empty()):
+            try:
+                batch = [collector.queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(collector.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if args.mode == 'timeline':
+                for obj in batch:
+                    events2csv.add_event(index, obj)
+            else:
+                origin = origin or batch[0]['lastTimestamp']
+                sink([events2csv.event_row(obj, events2csv.parse_time(origin)) for obj in batch])
+            written = written + len(batch)
+    finally:
+        if close is not None:
+            close()
+    if args.mode == 'timeline':
+        with open(args.output, 'w', newline="") as outf:
+            header, summary = events2csv.write_timeline(index, outf)
+        events2csv.print_summary(header, summary)
+        if args.summary:
+            with open(args.summary, 'w', newline="") as f:
+                csvout = csv.writer(f)
+                csvout.writerow(header)
+                csvout.writerows(summary)
+    return written
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if os.path.exists(args.output) and not args.append:
+        events2csv.confirm_overwrite(args.output)
+    config.load_kube_config(args.config)
+    collector = EventCollector(client.CoreV1Api(), args.namespace, args.existing)
+
+    # Stop on Ctrl-C, SIGTERM or when the duration expires, and write the queued events before exiting
+    signal.signal(signal.SIGINT, lambda signum, frame: collector.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.stop())
+    if args.duration:
+        timer = threading.Timer(args.duration, collector.stop)
+        timer.daemon = True
+        timer.start()
+
+    thread = threading.Thread(target=collector.run, name='eventwatch', daemon=True)
+    thread.start()
+    started = time.monotonic()
+    count = write_events(collector, args)
+    print('info: wrote %d event(s) in %.1f seconds' % (count, time.monotonic() - started))
+    sys.exit(0)
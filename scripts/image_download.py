@@ -1,43 +1,220 @@
-import sys
-import shlex
+import argparse
+import collections
+import concurrent.futures
+import json
+import random
 import subprocess
+import sys
+import threading
 import time
-import concurrent.futures
 
-verbose = False
+# Number of image names given to one 'docker image inspect' command
+INSPECT_BATCH = 200
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='download docker images in parallel.')
+    parser.add_argument('image_list', help='file with one image name per line. lines starting with # are ignored.')
+    parser.add_argument('--concurrency', '-j', type=int, default=10, help='max number of pulls at once (default: 10)')
+    parser.add_argument('--per-registry', type=int, default=4,
+                        help='max number of pulls at once from the same registry (default: 4)')
+    parser.add_argument('--retries', type=int, default=3, help='number of retries of a failed pull (default: 3)')
+    parser.add_argument('--backoff', type=float, default=2.0, metavar='SECONDS',
+                        help='wait before the first retry. doubled for each further retry (default: 2)')
+    parser.add_argument('--no-skip', action='store_true', help='pull images even if they already exist locally')
+    parser.add_argument('--verbose', '-v', action='store_true', help='show the output of docker pull')
+    return parser.parse_args()
+
+
+# read_images
+# return:
+#   image names in the file, without duplicates, in the order of the file
+def read_images(path):
+    images = []
+    with open(path) as f:
+        for image_name_raw in f:
+            image_name = image_name_raw.strip()
+            if not image_name or image_name.startswith('#'):
+                continue
+            images.append(image_name)
+    return list(dict.fromkeys(images))
+
+
+# registry_of
+# return:
+#   registry host of the image ('docker.io' if the name has no registry part)
+def registry_of(image_name):
+    first, sep, rest = image_name.partition('/')
+    if sep and ('.' in first or ':' in first or first == 'localhost'):
+        return first
+    return 'docker.io'
+
+
+# reference_of
+# Normalizes an image name to the form docker shows in RepoTags or RepoDigests.
+# 'docker.io/' and 'library/' of Docker Hub images are removed, and ':latest' is added if there is no tag.
+# A digest reference loses its tag, as RepoDigests have none.
+# return:
+#   normalized image name
+def reference_of(image_name):
+    name, at, digest = image_name.partition('@')
+    for prefix in ('docker.io/', 'index.docker.io/'):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+            break
+    if registry_of(name) == 'docker.io' and name.startswith('library/') and name.count('/') == 1:
+        name = name[len('library/'):]
+    repo, sep, last = name.rpartition('/')
+    if at:
+        return repo + sep + last.partition(':')[0] + '@' + digest
+    if ':' in last:
+        return name
+    return name + ':latest'
+
 
-def show_usage():
-    print("download docker images in parallel.")
+# inspect_images
+# Runs 'docker image inspect' for many images at once.
+# return:
+#   {image name: size in bytes} of the images that exist locally (empty if docker cannot be run)
+def inspect_images(images):
+    found = {}
+    for i in range(0, len(images), INSPECT_BATCH):
+        batch = images[i:i + INSPECT_BATCH]
+        # Missing images make docker exit with non-zero status, but the existing ones are still printed
+        try:
+            proc = subprocess.run(['docker', 'image', 'inspect', '--format',
+                                   '{"tags": {{json .RepoTags}}, "digests": {{json .RepoDigests}}, "size": {{.Size}}}']
+                                  + batch, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        except OSError as e:
+            print("warn: cannot run docker image inspect (%s)" % e)
+            return found
+        refs = {}
+        for line in proc.stdout.splitlines():
+            try:
+                info = json.loads(line)
+            except ValueError:
+                continue
+            for ref in (info.get('tags') or []) + (info.get('digests') or []):
+                refs[reference_of(ref)] = info.get('size') or 0
+        for image_name in batch:
+            if reference_of(image_name) in refs:
+                found[image_name] = refs[reference_of(image_name)]
+    return found
+
+
+# interleave
+# return:
+#   images ordered round-robin by registry, so that workers are not all waiting for the same registry
+def interleave(images):
+    queues = collections.OrderedDict()
+    for image_name in images:
+        queues.setdefault(registry_of(image_name), collections.deque()).append(image_name)
+    ordered = []
+    while queues:
+        for registry in list(queues):
+            ordered.append(queues[registry].popleft())
+            if not queues[registry]:
+                del queues[registry]
+    return ordered
+
+
+class PullScheduler:
+    """Pulls images with a limit of concurrent pulls in total and per registry, retrying failed pulls."""
+    def __init__(self, concurrency, per_registry, retries, backoff, verbose=False):
+        self.concurrency = concurrency
+        self.per_registry = per_registry
+        self.retries = retries
+        self.backoff = backoff
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._slots = {}
+        # image name -> {'seconds': ..., 'waited': ..., 'attempts': ..., 'returncode': ...}
+        # seconds is the time from the start of the first pull, waited is the time waiting for a registry slot
+        self.results = {}
+
+    def _slot(self, registry):
+        with self._lock:
+            if registry not in self._slots:
+                self._slots[registry] = threading.BoundedSemaphore(self.per_registry)
+            return self._slots[registry]
+
+    def pull_image(self, image_name):
+        submitted = time.monotonic()
+        start = None
+        returncode = None
+        attempt = 0
+        for attempt in range(1, self.retries + 2):
+            # Hold a slot of the registry only while pulling, not while waiting for the retry
+            with self._slot(registry_of(image_name)):
+                if start is None:
+                    start = time.monotonic()
+                print("pulling " + image_name + ("" if attempt == 1 else " (retry %d)" % (attempt - 1)))
+                p = subprocess.run(['docker', 'pull', image_name],
+                                   stdout=None if self.verbose else subprocess.DEVNULL)
+                returncode = p.returncode
+            if returncode == 0:
+                break
+            if attempt <= self.retries:
+                wait = self.backoff * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+                print("failed " + image_name + ", returncode=%d. retrying in %.1f seconds" % (returncode, wait))
+                time.sleep(wait)
+        seconds = time.monotonic() - start
+        print("finish " + image_name + ", returncode=%d, %.1f seconds" % (returncode, seconds))
+        with self._lock:
+            self.results[image_name] = {'seconds': seconds, 'waited': start - submitted, 'attempts': attempt,
+                                        'returncode': returncode}
+        return returncode
+
+    def run(self, images):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            for image_name in interleave(images):
+                print("submit " + image_name)
+                futures[executor.submit(self.pull_image, image_name)] = image_name
+            for future in concurrent.futures.as_completed(futures):
+                image_name = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # e.g. docker is not installed. Count it as a failed pull.
+                    print("failed " + image_name + " (%s)" % e)
+                    with self._lock:
+                        self.results[image_name] = {'seconds': 0.0, 'waited': 0.0, 'attempts': 1, 'returncode': None}
+        return self.results
+
+
+def report(results, sizes, skipped, elapsed):
     print()
-    print("usage: %s <image list file>" % (sys.argv[0]))
-
-def pull_image(image_name):
-    print("pulling " + image_name)
-    cmd_line = 'docker pull ' + image_name
-    cmd_args = shlex.split(cmd_line)
-    print("invoking " + cmd_line + " ...")
-    p = subprocess.Popen(cmd_args, stdout=subprocess.DEVNULL)
-    p.wait()
-    print("finish " + image_name + ", returncode=" + p.returncode)
-    return p.returncode
-
-if verbose:
-    print(sys.argv)
-
-if len(sys.argv) == 1:
-    show_usage()
-    sys.exit(0)
-
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-future_list = []
-
-with open(sys.argv[1]) as f:
-    for image_name_raw in f:
-        image_name = image_name_raw.strip()
-        if image_name.startswith('#'):
-            continue
-        print("submit " + image_name)
-        future = executor.submit(pull_image, image_name)
-        future_list.append(future)
-
-concurrent.futures.wait(future_list)
+    print('%-8s %8s %8s %8s %10s  %s' % ('RESULT', 'SECONDS', 'WAITED', 'ATTEMPTS', 'SIZE(MB)', 'IMAGE'))
+    for image_name, r in sorted(results.items(), key=lambda x: -x[1]['seconds']):
+        print('%-8s %8.1f %8.1f %8d %10s  %s' % ('ok' if r['returncode'] == 0 else 'failed', r['seconds'], r['waited'],
+                                                 r['attempts'],
+                                                 '%.1f' % (sizes[image_name] / 1e6) if image_name in sizes else '-',
+                                                 image_name))
+    pulled = [image_name for image_name, r in results.items() if r['returncode'] == 0]
+    total_mb = sum(sizes.get(image_name, 0) for image_name in pulled) / 1e6
+    print('pulled %d, failed %d, skipped %d (already present) in %.1f seconds' %
+          (len(pulled), len(results) - len(pulled), skipped, elapsed))
+    if elapsed > 0:
+        print('throughput: %.1f images/min, %.1f MB/s (uncompressed)' %
+              (len(pulled) * 60 / elapsed, total_mb / elapsed))
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    images = read_images(args.image_list)
+    skipped = []
+    if not args.no_skip:
+        present = inspect_images(images)
+        skipped = [image_name for image_name in images if image_name in present]
+        for image_name in skipped:
+            print("skip " + image_name + " (already present)")
+        images = [image_name for image_name in images if image_name not in present]
+
+    started = time.monotonic()
+    scheduler = PullScheduler(args.concurrency, args.per_registry, args.retries, args.backoff, args.verbose)
+    results = scheduler.run(images)
+    elapsed = time.monotonic() - started
+    sizes = inspect_images([image_name for image_name, r in results.items() if r['returncode'] == 0])
+    report(results, sizes, len(skipped), elapsed)
+    sys.exit(0 if all(r['returncode'] == 0 for r in results.values()) else 1)
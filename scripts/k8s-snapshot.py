@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+# vim: set ts=4 expandtab :
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import json
+import sys
+import time
+
+from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+
+# Use orjson if it is installed. It encodes and decodes large lists several times faster than the json module.
+try:
+    import orjson
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+# Resource types of k8s-get: name -> (API class, list method, namespaced)
+KINDS = collections.OrderedDict([
+    ('pods', (client.CoreV1Api, 'list_namespaced_pod', True)),
+    ('pvc', (client.CoreV1Api, 'list_namespaced_persistent_volume_claim', True)),
+    ('statefulset', (client.AppsV1Api, 'list_namespaced_stateful_set', True)),
+    ('secrets', (client.CoreV1Api, 'list_namespaced_secret', True)),
+    ('configmap', (client.CoreV1Api, 'list_namespaced_config_map', True)),
+    ('persistentvolume', (client.CoreV1Api, 'list_persistent_volume', False)),
+    ('services', (client.CoreV1Api, 'list_namespaced_service', True)),
+    ('deployment', (client.AppsV1Api, 'list_namespaced_deployment', True)),
+    ('replicaset', (client.AppsV1Api, 'list_namespaced_replica_set', True)),
+    ('jobs', (client.BatchV1Api, 'list_namespaced_job', True)),
+])
+
+# Max number of objects in one list response. Larger lists are fetched in pages.
+LIST_LIMIT = 500
+
+# Fields that change on every update and are not shown as changes by diff
+IGNORED_PATHS = {'metadata.resourceVersion'}
+
+# Max number of changed fields shown for one object
+MAX_PATHS = 5
+
+SNAPSHOT_VERSION = 1
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='save kubernetes objects of a namespace as a JSON snapshot, '
+                                                 'or show the changes between snapshots.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    save = sub.add_parser('save', help='fetch the objects and write a snapshot')
+    save.add_argument('output', nargs='?',
+                      help='snapshot file. compressed if it ends with .gz (default: k8s-snapshot-<date>.json)')
+    save.add_argument('--namespace', '-n', default='onap', help='namespace of the objects (default: onap)')
+    save.add_argument('--config', '-c', help='kubeconfig file (default: $KUBECONFIG or ~/.kube/config)')
+    save.add_argument('--kinds', '-k', default=','.join(KINDS),
+                      help='comma separated resource types (default: %s)' % ','.join(KINDS))
+    save.add_argument('--filter', '-f', help='only save objects whose name contains this text')
+    save.add_argument('--gzip', '-z', action='store_true', help='compress the default output file')
+    diff = sub.add_parser('diff', help='show the changes between consecutive snapshots')
+    diff.add_argument('snapshots', nargs='+', metavar='SNAPSHOT', help='two or more snapshot files, oldest first')
+    diff.add_argument('--kinds', '-k', help='comma separated resource types (default: all in the snapshots)')
+    args = parser.parse_args()
+    if args.command == 'diff' and len(args.snapshots) < 2:
+        parser.error('diff needs at least two snapshots')
+    if args.kinds:
+        args.kinds = [kind.strip() for kind in args.kinds.split(',') if kind.strip()]
+        unknown = [kind for kind in args.kinds if kind not in KINDS]
+        if unknown:
+            parser.error('unknown resource type: %s' % ', '.join(unknown))
+    return args
+
+
+# compact
+# Removes the fields that only make the snapshot large. Secret values are replaced by their digests,
+# so changes are still visible but the values are not written to the file.
+# params:
+#   obj ... object as a dict in the API (camelCase) form
+def compact(obj):
+    metadata = obj.get('metadata') or {}
+    metadata.pop('managedFields', None)
+    annotations = metadata.get('annotations') or {}
+    annotations.pop('kubectl.kubernetes.io/last-applied-configuration', None)
+    if obj.get('kind') == 'Secret':
+        for key in ('data', 'stringData'):
+            if obj.get(key):
+                obj[key] = {k: 'sha256:' + hashlib.sha256((v or '').encode()).hexdigest()[:16]
+                            for k, v in obj[key].items()}
+    return obj
+
+
+# list_kind
+# Lists all objects of a resource type, page by page. The response is decoded directly from JSON,
+# which is much faster than building the typed client models.
+# return:
+#   {name: object}
+def list_kind(api_client, kind, namespace):
+    api_class, method, namespaced = KINDS[kind]
+    func = getattr(api_class(api_client), method)
+    singular = ''.join(word.capitalize() for word in method.split('_')[2 if namespaced else 1:])
+    objects = {}
+    cont = None
+    while True:
+        params = {'limit': LIST_LIMIT, '_preload_content': False}
+        if cont:
+            params['_continue'] = cont
+        resp = func(namespace, **params) if namespaced else func(**params)
+        data = loads(resp.data)
+        for obj in data.get('items') or []:
+            # Items of a list have no kind
+            obj.setdefault('kind', singular)
+            objects[obj['metadata']['name']] = compact(obj)
+        cont = (data.get('metadata') or {}).get('continue')
+        if not cont:
+            return objects
+
+
+# take_snapshot
+# Fetches all resource types concurrently.
+# return:
+#   snapshot dict, or None if any resource type could not be fetched
+def take_snapshot(kinds, namespace, name_filter=None):
+    configuration = client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = len(kinds)
+    api_client = client.ApiClient(configuration)
+    snapshot = {'version': SNAPSHOT_VERSION, 'namespace': namespace,
+                'time': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'kinds': collections.OrderedDict()}
+    ok = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(kinds)) as executor:
+        futures = collections.OrderedDict((kind, executor.submit(list_kind, api_client, kind, namespace))
+                                          for kind in kinds)
+        for kind, future in futures.items():
+            try:
+                objects = future.result()
+            except ApiException as e:
+                print('error: failed to list %s (%s %s)' % (kind, e.status, e.reason))
+                ok = False
+                continue
+            if name_filter:
+                objects = {name: obj for name, obj in objects.items() if name_filter in name}
+            snapshot['kinds'][kind] = objects
+    return snapshot if ok else None
+
+
+def write_snapshot(path, snapshot):
+    data = dumps(snapshot)
+    if path.endswith('.gz'):
+        with gzip.open(path, 'wb', compresslevel=6) as f:
+            f.write(data)
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # gzip magic number
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    snapshot = loads(data)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        print('error: %s is not a snapshot of version %d' % (path, SNAPSHOT_VERSION))
+        sys.exit(1)
+    return snapshot
+
+
+# changed_paths
+# params:
+#   old, new ... values to compare
+#   prefix ... dotted path of the values
+# return:
+#   dotted paths of the changed fields. lists are compared as a whole.
+def changed_paths(old, new, prefix=''):
+    if old == new or prefix in IGNORED_PATHS:
+        return []
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return [prefix or '.']
+    paths = []
+    for key in sorted(set(old) | set(new), key=str):
+        paths.extend(changed_paths(old.get(key), new.get(key), prefix + '.' + key if prefix else key))
+    return paths
+
+
+# diff_snapshots
+# Prints the objects added, removed and changed from old to new, one resource type at a time.
+# return:
+#   number of differences
+def diff_snapshots(old, new, kinds=None):
+    count = 0
+    old_kinds = old['kinds']
+    new_kinds = new['kinds']
+    for kind in kinds or [k for k in KINDS if k in old_kinds or k in new_kinds]:
+        if kind not in old_kinds or kind not in new_kinds:
+            print('%s: only in the %s snapshot' % (kind, 'new' if kind in new_kinds else 'old'))
+            continue
+        before = old_kinds[kind]
+        after = new_kinds[kind]
+        lines = []
+        for name in sorted(set(before) | set(after)):
+            if name not in before:
+                lines.append('+ ' + name)
+            elif name not in after:
+                lines.append('- ' + name)
+            else:
+                paths = changed_paths(before[name], after[name])
+                if paths:
+                    lines.append('~ %s: %s%s' % (name, ', '.join(paths[:MAX_PATHS]),
+                                                 ', ...' if len(paths) > MAX_PATHS else ''))
+        if lines:
+            print('======== type: %s ========' % kind)
+            for line in lines:
+                print(line)
+            print()
+        count = count + len(lines)
+    return count
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.command == 'save':
+        config.load_kube_config(args.config)
+        started = time.monotonic()
+        snapshot = take_snapshot(args.kinds, args.namespace, args.filter)
+        if snapshot is None:
+            print('kubernetes API error. Please check envvar KUBECONFIG points to proper config file.')
+            sys.exit(1)
+        output = args.output
+        if not output:
+            output = 'k8s-snapshot-%s%s.json%s' % (args.filter.replace(' ', '') + '-' if args.filter else '',
+                                                   time.strftime('%y%m%d-%H%M%S'), '.gz' if args.gzip else '')
+        write_snapshot(output, snapshot)
+        print(' '.join('%s=%d' % (kind, len(objects)) for kind, objects in snapshot['kinds'].items()))
+        print('snapshot is saved as %s (%.1f seconds).' % (output, time.monotonic() - started))
+    else:
+        # Only two snapshots are held in memory at a time
+        total = 0
+        old_path = args.snapshots[0]
+        old = read_snapshot(old_path)
+        for new_path in args.snapshots[1:]:
+            new = read_snapshot(new_path)
+            print('#### %s (%s) -> %s (%s)' % (old_path, old['time'], new_path, new['time']))
+            total = total + diff_snapshots(old, new, args.kinds)
+            old_path, old = new_path, new
+        sys.exit(1 if total else 0)
@@ -1,8 +1,36 @@
 #!/usr/bin/python3
 # vim: set ts=4 expandtab :
 
+import argparse
+import collections
+import concurrent.futures
 import sys
-import subprocess
+import time
+
+from kubernetes import client, config, dynamic, watch
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic.exceptions import DynamicApiError, GoneError, NotFoundError, ResourceNotFoundError, \
+    ResourceNotUniqueError
+
+# Seconds to wait for all deleted objects to disappear
+DEFAULT_TIMEOUT = 300
+
+# Max number of delete requests at once
+DEFAULT_CONCURRENCY = 10
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='delete the kubernetes objects found in a helm log.')
+    parser.add_argument('log_file', help='helm log containing the rendered manifests')
+    parser.add_argument('--namespace', '-n', default='onap', help='namespace of the objects (default: onap)')
+    parser.add_argument('--config', '-c', help='kubeconfig file (default: $KUBECONFIG or ~/.kube/config)')
+    parser.add_argument('--concurrency', '-j', type=int, default=DEFAULT_CONCURRENCY,
+                        help='max number of delete requests at once (default: %d)' % DEFAULT_CONCURRENCY)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, metavar='SECONDS',
+                        help='max seconds to wait for the objects to disappear (default: %d)' % DEFAULT_TIMEOUT)
+    parser.add_argument('--no-wait', action='store_true', help='do not wait for the objects to disappear')
+    return parser.parse_args()
+
 
 # find_name
 # params:
@@ -15,17 +43,151 @@ def find_name(f):
             name = line.split(': ')[1].strip()
             return name
 
+
+# find_objects
+# params:
+#   f ... file
+# return:
+#   {(apiVersion, kind): [name, ...]} in the order of the log, without duplicates.
+#   apiVersion is None if the manifest has no apiVersion before the kind.
+def find_objects(f):
+    groups = collections.OrderedDict()
+    api_version = None
+    for line in f:
+        if line.startswith('---'):
+            api_version = None
+        elif line.startswith('apiVersion:'):
+            api_version = line.split(': ')[1].strip()
+        elif line.startswith('kind:'):
+            kind = line.split(': ')[1].strip()
+            name = find_name(f)
+            print('kind=%s name=%s' % (kind, name))
+            if name:
+                names = groups.setdefault((api_version, kind), [])
+                if name not in names:
+                    names.append(name)
+            api_version = None
+    return groups
+
+
+# resolve_resource
+# return:
+#   API resource of the kind, or None if the API server does not serve it (no object of it can exist)
+def resolve_resource(dyn, api_version, kind):
+    try:
+        if api_version:
+            return dyn.resources.get(api_version=api_version, kind=kind)
+        return dyn.resources.get(kind=kind)
+    except (ResourceNotFoundError, ResourceNotUniqueError) as e:
+        print('warn: cannot resolve %s %s (%s)' % (api_version or '', kind, e))
+        return None
+
+
+# delete_object
+# Deletes an object without waiting for its dependents (background propagation).
+# return:
+#   'deleted', 'not found' or 'failed: <reason>'
+def delete_object(dyn, resource, namespace, name):
+    try:
+        dyn.delete(resource, name=name, namespace=namespace if resource.namespaced else None,
+                   propagation_policy='Background')
+        return 'deleted'
+    except NotFoundError:
+        return 'not found'
+    except DynamicApiError as e:
+        return 'failed: %s' % (e.reason or e.status)
+
+
+# wait_deleted
+# Lists the objects of the kind, then watches until none of the names is left or the deadline passes.
+# return:
+#   names still existing at the deadline
+def wait_deleted(dyn, resource, namespace, names, deadline):
+    namespace = namespace if resource.namespaced else None
+    remaining = set(names)
+    while remaining:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            break
+        try:
+            resp = dyn.get(resource, namespace=namespace)
+            remaining = remaining & {item.metadata.name for item in resp.items}
+            if not remaining:
+                break
+            w = watch.Watch()
+            for event in dyn.watch(resource, namespace=namespace, resource_version=resp.metadata.resourceVersion,
+                                   timeout=max(1, int(left)), watcher=w):
+                if event['type'] == 'ERROR':
+                    # 410 Gone etc. List the objects again.
+                    break
+                if event['type'] == 'DELETED':
+                    remaining.discard(event['object'].metadata.name)
+                    if not remaining:
+                        break
+            w.stop()
+        except GoneError:
+            continue
+        except ApiException as e:
+            # The watch raises ApiException for an ERROR event (e.g. 410 Gone)
+            if e.status != 410:
+                print('warn: watching %s failed (%s)' % (resource.kind, e.reason))
+                time.sleep(min(1, max(0, deadline - time.monotonic())))
+        except DynamicApiError as e:
+            print('warn: watching %s failed (%s)' % (resource.kind, e.reason or e.status))
+            time.sleep(min(1, max(0, deadline - time.monotonic())))
+    return remaining
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Error: No filename provided.')
-        sys.exit(1)
-    with open(sys.argv[1], encoding='utf-8', newline='') as log_file:
-        for line in log_file:
-            if line.startswith('kind:'):
-                kind = line.split(': ')[1].strip()
-                name = find_name(log_file)
-                print('kind=%s name=%s' % (kind, name))
-                cmd = 'kubectl delete -n onap %s %s' % (kind, name)
-                print('invoking: %s' % cmd)
-                comp_proc = subprocess.run(cmd, shell=True)
-                print('result; %d' % comp_proc.returncode)
+    args = parse_arguments()
+    with open(args.log_file, encoding='utf-8', newline='') as log_file:
+        groups = find_objects(log_file)
+
+    config.load_kube_config(args.config)
+    dyn = dynamic.DynamicClient(client.ApiClient())
+    started = time.monotonic()
+
+    resources = collections.OrderedDict()
+    for (api_version, kind), names in groups.items():
+        resource = resolve_resource(dyn, api_version, kind)
+        if resource is not None:
+            resources[(api_version, kind)] = resource
+
+    # Delete all objects concurrently, grouped by kind
+    failed = []
+    deleted = collections.OrderedDict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = collections.OrderedDict()
+        for key, resource in resources.items():
+            for name in groups[key]:
+                futures[(key, name)] = executor.submit(delete_object, dyn, resource, args.namespace, name)
+        for (key, name), future in futures.items():
+            result = future.result()
+            print('%s %s: %s' % (key[1], name, result))
+            if result == 'deleted':
+                deleted.setdefault(key, []).append(name)
+            elif result != 'not found':
+                failed.append('%s %s' % (key[1], name))
+    print('info: deleted %d object(s) in %.1f seconds' %
+          (sum(len(names) for names in deleted.values()), time.monotonic() - started))
+
+    # Wait for the deleted objects to disappear, one watch per kind
+    remaining = []
+    if deleted and not args.no_wait:
+        deadline = time.monotonic() + args.timeout
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(deleted)) as executor:
+            futures = collections.OrderedDict(
+                (key, executor.submit(wait_deleted, dyn, resources[key], args.namespace, names, deadline))
+                for key, names in deleted.items())
+            for key, future in futures.items():
+                remaining.extend('%s %s' % (key[1], name) for name in sorted(future.result()))
+        if remaining:
+            print('warn: %d object(s) still exist after %d seconds:' % (len(remaining), args.timeout))
+            for obj in remaining:
+                print('  ' + obj)
+        else:
+            print('info: all objects disappeared in %.1f seconds' % (time.monotonic() - started))
+
+    for obj in failed:
+        print('error: failed to delete %s' % obj)
+    sys.exit(1 if failed or remaining else 0)
@@ -7,38 +7,69 @@
 # See https://opensource.org/licenses/MIT .
 # ---------------------------------------------------------------------------
 
+from __future__ import annotations
+
 import argparse
+import concurrent.futures
 import json
 import logging
 import os
-import re
 import subprocess
 import sys
+import threading
 import time
+import typing
 
-import kubernetes.client
 import yaml
-from kubernetes import config, client
-
-# ホームディレクトリの取得
-if os.name == 'nt':
-    # Windows の場合は USERPROFILE 環境変数を使用
-    home_dir = os.environ.get('USERPROFILE', '')
-else:
-    home_dir = os.environ.get('HOME', '')
-
-# --config オプションが指定されなかった時にデフォルトで検索する kubeconfig ファイルのパス
-# KUBECONFIG 環境変数が空であった場合は取り除くために filter を使用
-DEFAULT_KUBECONFIG = list(filter(None, [
-    os.path.join(os.path.curdir, 'kubeconfig'),
-    os.environ.get('KUBECONFIG', ''),
-    os.path.join(home_dir, '.kube', 'config')
-]))
+
+import kubeclient
+from helmrelease import RELEASE_SECRET_SELECTOR, releases_from_json, releases_from_secrets
+from informer import NamespaceInformer, event_time
+from journal import DeployJournal, input_digest
+from prefetch import ImagePrefetcher, images_from_manifests, prefetch_name
+from scheduler import DeployScheduler
+from timeline import Timeline
+
+# kubernetes パッケージは API を使う時点で kubeclient が読み込む。型注釈のためだけに読み込まない
+if typing.TYPE_CHECKING:
+    import kubernetes.client
 
 # --namespace オプションが指定されなかった時に使用する namespace 名
 DEFAULT_NAMESPACE = 'onap'
 
-READY_CHECK_INTERVAL = 30
+# Release のオブジェクトがキャッシュに見つからない時に、watch の反映を待つ秒数
+EMPTY_RELEASE_GRACE = 5
+
+# Pod のコンテナがこれらの理由で待機している場合は失敗状態とみなす
+FAILURE_REASONS = {'ImagePullBackOff', 'ErrImagePull', 'InvalidImageName', 'ErrImageNeverPull', 'CrashLoopBackOff',
+                   'CreateContainerConfigError', 'CreateContainerError', 'RunContainerError'}
+
+# --fail-grace オプションが指定されなかった時に、失敗状態が続いた Pod を待つ秒数
+DEFAULT_FAIL_GRACE = 180
+
+# CrashLoopBackOff のコンテナがこの回数以上再起動していたら猶予を待たずに失敗とみなす
+CRASH_LOOP_LIMIT = 5
+
+# キャッシュが更新されなくても Ready 判定を再評価する間隔 (秒)
+RECHECK_INTERVAL = 10
+
+# 診断メッセージに含める Pod ごとの Warning イベント数
+DIAGNOSIS_EVENTS = 3
+
+# デプロイするチャート
+CHART = 'local/onap'
+
+# Helm の Release の Secret を一覧取得する時の 1 回あたりの件数
+RELEASE_LIST_LIMIT = 500
+
+# --journal オプションが指定されなかった時に使用するデプロイ記録ファイルのパス
+DEFAULT_JOURNAL = 'deploy-journal.json'
+
+# --parallel オプションが指定されなかった時に同時に実行する helm deploy の数 (Ready 待ちは数に含めない)
+DEFAULT_PARALLEL = 4
+
+# --prefetch オプション指定時に同時に実行するイメージの先行取得の数
+PREFETCH_PARALLEL = 2
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
@@ -49,6 +80,11 @@ class HelmError(Exception):
     pass
 
 
+class ReadinessError(Exception):
+    """Ready 待ちの失敗 (タイムアウトや Pod の異常) を表すエラー"""
+    pass
+
+
 class DeploymentDescriptor:
     """デプロイ定義ファイルのデータモデル"""
     def __init__(self):
@@ -58,6 +94,9 @@ class DeploymentDescriptor:
         self.readiness_timeout = 300
         self.master_password = 'pw'
         self.deploy_order = []
+        self.dependencies = {}
+        self.label_selector = None
+        self.stage_timeout = None
 
     @staticmethod
     def from_file(path: str):
@@ -69,14 +108,48 @@ class DeploymentDescriptor:
         desc.base_override = os.path.expanduser(str(data['base_override']))
         desc.readiness_timeout = int(data['readiness_timeout'])
         desc.master_password = str(data['master_password'])
-        desc.deploy_order = data['deploy_order']
+        desc.deploy_order = data.get('deploy_order') or []
+        desc.dependencies = {str(k): [str(x) for x in (v or [])]
+                             for k, v in (data.get('dependencies') or {}).items()}
+        desc.label_selector = data.get('label_selector')
+        if data.get('stage_timeout') is not None:
+            desc.stage_timeout = int(data['stage_timeout'])
+        if not desc.deploy_order and not desc.dependencies:
+            raise KeyError('deploy_order')
         return desc
 
+    def dependency_graph(self) -> dict:
+        """subchart ごとの依存先を返す。
+
+        deploy_order はステージの一覧の省略記法として扱い、各ステージの subchart は直前のステージの全 subchart に
+        依存するものとみなす。dependencies に記載された subchart はその記載内容を優先する。
+
+        :return: subchart 名をキー、依存先 subchart 名の集合を値とする辞書
+        :rtype: dict
+        """
+        graph = {}
+        previous = []
+        for subcharts in self.deploy_order:
+            for subchart in subcharts:
+                graph.setdefault(str(subchart), set(previous))
+            previous = [str(x) for x in subcharts]
+        for subchart, deps in self.dependencies.items():
+            graph[subchart] = set(deps)
+        return graph
+
+    def stage_of(self, subchart: str):
+        """subchart が属する deploy_order のステージ番号 (1 始まり) を返す。どのステージにも無い場合は None を返す。
+        """
+        for stage, subcharts in enumerate(self.deploy_order, 1):
+            if subchart in [str(x) for x in subcharts]:
+                return stage
+        return None
+
     def __str__(self):
         return 'DeploymentDescriptor(namespace=%s, release_name=%s, base_override=%s, ' \
-               'timeout=%d, password=%s, deploy_order=%s)' % (
+               'timeout=%d, password=%s, deploy_order=%s, dependencies=%s)' % (
                    self.namespace, self.release_name, self.base_override, self.readiness_timeout, self.master_password,
-                   self.deploy_order)
+                   self.deploy_order, self.dependencies)
 
 
 def setup_logging() -> None:
@@ -111,110 +184,351 @@ def parse_cmdline_args() -> argparse.Namespace:
     parser.add_argument('--namespace', '-n', help='kubernetes namespace where ONAP is deployed.',
                         default=DEFAULT_NAMESPACE)
     parser.add_argument('--descriptor', '-d', help='deployment descriptor file.', metavar='FILE')
+    parser.add_argument('--parallel', '-p', help='max number of helm deploys run at once.', type=int,
+                        default=DEFAULT_PARALLEL, metavar='N')
+    parser.add_argument('--selector', '-l', help='label selector to narrow down the watched workloads on the server.',
+                        metavar='SELECTOR')
+    parser.add_argument('--timeout', '-t', help='readiness timeout in seconds per workload (overrides descriptor).',
+                        type=int, metavar='SECONDS')
+    parser.add_argument('--fail-grace', help='abort when a pod stays in a failure state such as ImagePullBackOff '
+                                             'longer than this (seconds).',
+                        type=int, default=DEFAULT_FAIL_GRACE, metavar='SECONDS')
+    parser.add_argument('--trace', help='write a Chrome trace (JSON timeline) of the run to this file.',
+                        metavar='FILE')
+    parser.add_argument('--journal', '-j', help='deploy journal file used to redeploy only changed subcharts.',
+                        default=DEFAULT_JOURNAL, metavar='FILE')
+    parser.add_argument('--plan', help='print the dependency plan (critical path etc.) and exit.',
+                        action='store_true', default=False)
+    parser.add_argument('--prefetch', help='pull the images of the subcharts that depend on a starting subchart '
+                                           'on all nodes ahead of their deploy.',
+                        action='store_true', default=False)
     return parser.parse_args()
 
 
-def wait_for_ready(api: kubernetes.client.AppsV1Api, ns: str, release_name: str) -> None:
-    """指定されたHelmのReleaseで生成されたDeploymentやStatefulSetなどのオブジェクトが全てReadyになるまで待機する。
+def _replica_counts(obj) -> tuple:
+    """Deployment や StatefulSet の (desired, ready) レプリカ数を返す。
+    """
+    desired = obj.spec.replicas or 0
+    ready = (obj.status.ready_replicas or 0) if obj.status else 0
+    return desired, ready
 
-    :param any api: Kubernetes API オブジェクト
+
+def create_informer(apps_api: kubernetes.client.AppsV1Api, core_api: kubernetes.client.CoreV1Api, ns: str,
+                    label_selector: str = None) -> NamespaceInformer:
+    """Deployment, StatefulSet と、その診断に使う Pod, Event を追跡する Namespace 単位のキャッシュを作成して開始する。
+
+    :param any apps_api: Kubernetes apps v1 API オブジェクト
+    :param any core_api: Kubernetes core v1 API オブジェクト
     :param str ns: 対象のNamespace
+    :param str label_selector: Deployment, StatefulSet をサーバ側で絞り込むためのラベルセレクタ
+    """
+    informer = NamespaceInformer(ns, {
+        'Deployment': apps_api.list_namespaced_deployment,
+        'StatefulSet': apps_api.list_namespaced_stateful_set,
+        'Pod': core_api.list_namespaced_pod,
+        'Event': core_api.list_namespaced_event,
+    }, label_selector, selector_kinds=['Deployment', 'StatefulSet'])
+    informer.start()
+    return informer
+
+
+def release_ready(informer: NamespaceInformer, release_name: str) -> bool:
+    """Release のワークロードがキャッシュ上で全て Ready かどうかを、待機せずに返す。
+    """
+    informer.wait_for_sync()
+    targets = informer.by_release(release_name, ['Deployment', 'StatefulSet'])
+    return bool(targets) and all(desired == ready for desired, ready in (_replica_counts(obj) for k, obj in targets))
+
+
+def _pod_problems(pod) -> list:
+    """Pod のコンテナのうち、失敗状態で待機しているものを (コンテナ名, 理由, メッセージ, 再起動回数) のリストで返す。
+    """
+    problems = []
+    status = pod.status
+    if status is None:
+        return problems
+    for cs in (status.init_container_statuses or []) + (status.container_statuses or []):
+        waiting = cs.state.waiting if cs.state else None
+        if waiting is not None and waiting.reason in FAILURE_REASONS:
+            problems.append((cs.name, waiting.reason, waiting.message or '', cs.restart_count or 0))
+    for cond in status.conditions or []:
+        if cond.type == 'PodScheduled' and cond.status == 'False' and cond.reason == 'Unschedulable':
+            problems.append(('-', cond.reason, cond.message or '', 0))
+    return problems
+
+
+def _diagnose(informer: NamespaceInformer, workloads: list) -> list:
+    """Ready になっていないワークロードについて、Pod の状態と直近の Warning イベントを説明する行のリストを返す。
+    """
+    lines = []
+    for kind, obj in workloads:
+        desired, ready = _replica_counts(obj)
+        lines.append('%s %s (desired=%d, ready=%d)' % (kind, obj.metadata.name, desired, ready))
+        for pod in informer.select_by('Pod', obj.spec.selector):
+            for container, reason, message, restarts in _pod_problems(pod):
+                lines.append('  pod %s container %s: %s (restarts=%d) %s' % (
+                    pod.metadata.name, container, reason, restarts, message))
+            warnings = [e for e in informer.events_for('Pod', pod.metadata.name) if e.type == 'Warning']
+            for event in warnings[-DIAGNOSIS_EVENTS:]:
+                lines.append('  pod %s event %s: %s' % (pod.metadata.name, event.reason, event.message))
+    return lines
+
+
+def wait_for_ready(informer: NamespaceInformer, release_name: str, timeout: float = None, deadline: float = None,
+                   fail_grace: float = DEFAULT_FAIL_GRACE, timeline: Timeline = None) -> None:
+    """指定されたHelmのReleaseで生成されたDeploymentやStatefulSetなどのオブジェクトが全てReadyになるまで待機する。
+
+    状態は全て Namespace 単位のキャッシュから読み出し、キャッシュの更新のたびに再評価する。
+    Release 内の最後の 1 つが Ready になった時点で待機を終了する。
+    Pod が ImagePullBackOff や CrashLoopBackOff などの失敗状態から抜け出せない場合は、タイムアウトを待たずに中止する。
+
+    :param informer: 対象の Namespace のキャッシュ
     :param str release_name: Release Name
+    :param float timeout: 各ワークロードが Ready になるまでの制限時間 (秒)。None の場合は無制限
+    :param float deadline: 待機を打ち切る時刻 (time.monotonic() の値)。ステージの制限時間に使用する
+    :param float fail_grace: Pod が失敗状態のまま続いた場合に中止するまでの猶予 (秒)
+    :param timeline: 指定された場合、各ワークロードが Ready になるまでの区間を記録する
+    :raises ReadinessError: 制限時間を過ぎた場合、または Pod の失敗状態を検出した場合
     """
     _logger.info("Looking up resources for %s", release_name)
+    start = time.monotonic()
+    started_at = time.time()
+    limits = [x for x in [deadline, start + timeout if timeout else None] if x is not None]
+    limit = min(limits) if limits else None
+
+    informer.wait_for_sync()
+    # helm 終了直後は watch の反映が間に合っていない可能性があるため、オブジェクトが見つからない場合は少し待つ
+    targets = informer.wait_until(lambda: informer.by_release(release_name), EMPTY_RELEASE_GRACE)
+    for kind in ['Deployment', 'StatefulSet']:
+        _logger.info("%ss: %s", kind, [obj.metadata.name for k, obj in targets if k == kind])
+
+    reported = {}
+    first_seen = {}
+    pending = []
+    fatal = []
+    # Pod の失敗状態の走査は Namespace の全 Pod を対象とするため、Pod が変化した時と一定間隔の再評価の時だけ行う。
+    # Event などの更新のたびに全ての待機スレッドで走査すると、キャッシュのロックを長く保持して watch を妨げる
+    scan = {'due': True, 'pods': None}
+
+    def all_ready() -> bool:
+        pending.clear()
+        fatal.clear()
+        for kind, obj in informer.by_release(release_name, ['Deployment', 'StatefulSet']):
+            name = obj.metadata.name
+            desired, ready = _replica_counts(obj)
+            # 状態が変化した時だけログを出力する
+            if reported.get((kind, name)) != (desired, ready):
+                reported[(kind, name)] = (desired, ready)
+                if desired == ready:
+                    _logger.info('%s / %s %s is ready', release_name, kind, name)
+                    if timeline is not None:
+                        timeline.add('%s %s' % (kind, name), 'readiness', started_at, time.time(), release_name)
+                else:
+                    _logger.info('Waiting for %s %s to be ready (desired=%d, ready=%d)...', kind, name, desired,
+                                 ready)
+            if desired != ready:
+                pending.append((kind, obj))
+        if not pending:
+            return True
+        pods_version = informer.version('Pod')
+        if not scan['due'] and pods_version == scan['pods']:
+            return False
+        scan['due'] = False
+        scan['pods'] = pods_version
+
+        # 失敗状態の Pod を検出する。同じ状態が fail_grace 秒以上続いた場合に失敗とみなす
+        now = time.monotonic()
+        current = set()
+        for kind, obj in pending:
+            for pod in informer.select_by('Pod', obj.spec.selector):
+                for container, reason, message, restarts in _pod_problems(pod):
+                    key = (pod.metadata.name, container, reason)
+                    current.add(key)
+                    since = first_seen.setdefault(key, now)
+                    if now - since >= fail_grace or (reason == 'CrashLoopBackOff' and restarts >= CRASH_LOOP_LIMIT):
+                        fatal.append((kind, obj))
+                        break
+        for key in list(first_seen):
+            if key not in current:
+                del first_seen[key]
+        return bool(fatal)
+
+    while True:
+        # 失敗状態の継続時間を評価するため、キャッシュが更新されなくても一定間隔で再評価する
+        wait = RECHECK_INTERVAL if limit is None else max(0.0, min(RECHECK_INTERVAL, limit - time.monotonic()))
+        scan['due'] = True
+        informer.wait_until(all_ready, wait)
+        if fatal:
+            lines = _diagnose(informer, fatal)
+            for line in lines:
+                _logger.error('%s: %s', release_name, line)
+            # 最後に出力する失敗一覧に原因が残るよう、ワークロードの行に加えて最初の Pod の問題を含める
+            cause = next((line.strip() for line in lines if line.startswith('  pod ')), None)
+            raise ReadinessError('%s: pods are stuck in a failure state: %s%s' % (
+                release_name, lines[0], ': ' + cause if cause else ''))
+        if not pending:
+            return
+        if limit is not None and time.monotonic() >= limit:
+            lines = _diagnose(informer, pending)
+            for line in lines:
+                _logger.error('%s: %s', release_name, line)
+            raise ReadinessError('%s: timed out after %d seconds waiting for %s' % (
+                release_name, time.monotonic() - start, ', '.join(obj.metadata.name for kind, obj in pending)))
+
+
+def record_image_pulls(informer: NamespaceInformer, timeline: Timeline, release_name: str) -> None:
+    """Release の Pod の Pulling / Pulled イベントから、イメージの取得にかかった区間を記録する。
+
+    イベントの時刻は秒単位のため、短いイメージ取得は 0 秒として記録される。
+    """
+    for kind, obj in informer.by_release(release_name, ['Deployment', 'StatefulSet']):
+        for pod in informer.select_by('Pod', obj.spec.selector):
+            pulling = {}
+            for event in informer.events_for('Pod', pod.metadata.name):
+                field_path = event.involved_object.field_path
+                if event.reason == 'Pulling':
+                    pulling.setdefault(field_path, event)
+                elif event.reason == 'Pulled' and field_path in pulling:
+                    begin = event_time(pulling.pop(field_path))
+                    timeline.add('pull %s %s' % (pod.metadata.name, field_path), 'image-pull', begin.timestamp(),
+                                 event_time(event).timestamp(), release_name, message=event.message)
+
+
+def helm_set_values(desc: DeploymentDescriptor, subchart: str) -> list:
+    """subchart のデプロイ時に helm へ --set で渡す 'key=value' のリストを返す。
+    """
+    return ['global.masterPassword=%s' % desc.master_password, '%s.enabled=true' % subchart]
 
-    # Deployments を取得し、annotation の release_name が一致するものを抽出
-    deployments = api.list_namespaced_deployment(ns)
-    watch_deps = [x for x in deployments.items if
-                  'meta.helm.sh/release-name' in x.metadata.annotations and
-                  x.metadata.annotations['meta.helm.sh/release-name'] == release_name]
-    _logger.info("Deployments: %s", [x.metadata.name for x in watch_deps])
-
-    # StatefulSets を取得し、annotation の release_name が一致するものを抽出
-    statefulsets = api.list_namespaced_stateful_set(ns)
-    watch_statesets = [x for x in statefulsets.items if
-                       'meta.helm.sh/release-name' in x.metadata.annotations and
-                       x.metadata.annotations['meta.helm.sh/release-name'] == release_name]
-    _logger.info("StatefulSets: %s", [x.metadata.name for x in watch_statesets])
-
-    # それぞれの deployment が replica 数分 ready になるのを待つ
-    for deployment in watch_deps:
-        name = deployment.metadata.name
-        desired = deployment.spec.replicas or 0
-        latest_status = api.read_namespaced_deployment_status(name, ns)
-        ready = latest_status.status.ready_replicas or 0
-        while desired != ready:
-            _logger.info('Waiting for Deployment %s to be ready (desired=%d, ready=%d)...', name, desired, ready)
-            time.sleep(READY_CHECK_INTERVAL)
-            # Get the latest status
-            latest_status = api.read_namespaced_deployment_status(name, ns)
-            ready = latest_status.status.ready_replicas or 0
-        _logger.info('%s / Deployment %s is ready', release_name, name)
-
-    # それぞれの statefulset が replica 数分 ready になるのを待つ
-    for statefulset in watch_statesets:
-        name = statefulset.metadata.name
-        desired = statefulset.spec.replicas or 0
-        latest_status = api.read_namespaced_stateful_set_status(name, ns)
-        ready = latest_status.status.ready_replicas or 0
-        while desired != ready:
-            _logger.info('Waiting for StatefulSet %s to be ready (desired=%d, ready=%d)...', name, desired, ready)
-            time.sleep(READY_CHECK_INTERVAL)
-            # Get the latest status
-            latest_status = api.read_namespaced_stateful_set_status(name, ns)
-            ready = latest_status.status.ready_replicas or 0
-        _logger.info('%s / StatefulSet %s is ready', release_name, name)
+
+def chart_version(chart: str = CHART) -> str:
+    """helm show chart でチャートのバージョンを取得する。
+
+    :raises HelmError: helm が見つからない、または 0 以外の終了コードを返した場合
+    """
+    helm_cmd = ['helm', 'show', 'chart', chart]
+    _logger.info('Running: %s', ' '.join(helm_cmd))
+    try:
+        helm_result = subprocess.run(helm_cmd, stdout=subprocess.PIPE)
+    except FileNotFoundError as e:
+        raise HelmError('helm not found. Please install helm and try again. %s' % e) from e
+    if helm_result.returncode != 0:
+        raise HelmError('helm returned an error (code=%d).' % helm_result.returncode)
+    return str((yaml.safe_load(helm_result.stdout) or {}).get('version'))
 
 
 def deploy_subchart(desc: DeploymentDescriptor, subchart: str) -> None:
-    """Helm で指定された subchart をインストールする。
+    """Helm で指定された subchart をインストールする。インストール済みの場合はアップグレードする。
+
+    helm の出力は subchart ごとに helm-deploy-<release>.log へ書き出す。
+
+    :raises HelmError: helm が見つからない、または 0 以外の終了コードを返した場合
     """
     subchart_release = '%s-%s' % (desc.release_name, subchart)
-    helm_cmd = ['helm', 'deploy', subchart_release, 'local/onap', '--namespace', desc.namespace, '-f',
-                desc.base_override,
-                '--set', 'global.masterPassword=%s' % desc.master_password,
-                '--set', '%s.enabled=true' % subchart, '--verbose', '--debug']
-    _logger.info('Running: %s', ' '.join(helm_cmd))
+    helm_cmd = ['helm', 'deploy', subchart_release, CHART, '--namespace', desc.namespace, '-f',
+                desc.base_override]
+    for value in helm_set_values(desc, subchart):
+        helm_cmd += ['--set', value]
+    helm_cmd += ['--verbose', '--debug']
+    log_path = 'helm-deploy-%s.log' % subchart_release
+    _logger.info('Running: %s (output: %s)', ' '.join(helm_cmd), log_path)
     try:
-        with open('helm-deploy.log', 'a') as f:
-            helm_result = subprocess.run(helm_cmd, stdout=f)
-        # helm deploy の終了コードが 0 以外の場合は処理中止
-        _logger.info('Return code: %d', helm_result.returncode)
-        if helm_result.returncode != 0:
-            _logger.error('helm returned an error. aborted.')
-            sys.exit(helm_result.returncode)
+        with open(log_path, 'a') as f:
+            helm_result = subprocess.run(helm_cmd, stdout=f, stderr=subprocess.STDOUT)
     except FileNotFoundError as e:
-        _logger.exception('helm not found. Please install helm and try again. %s', e)
-        sys.exit(1)
+        raise HelmError('helm not found. Please install helm and try again. %s' % e) from e
+    _logger.info('%s: return code: %d', subchart_release, helm_result.returncode)
+    if helm_result.returncode != 0:
+        raise HelmError('helm returned an error (code=%d). see %s' % (helm_result.returncode, log_path))
+
+
+def render_manifests(desc: DeploymentDescriptor, subchart: str) -> str:
+    """helm template で subchart のデプロイ時と同じ入力からマニフェストを生成して返す。
+
+    :raises HelmError: helm が見つからない、または 0 以外の終了コードを返した場合
+    """
+    subchart_release = '%s-%s' % (desc.release_name, subchart)
+    helm_cmd = ['helm', 'template', subchart_release, CHART, '--namespace', desc.namespace, '-f', desc.base_override]
+    for value in helm_set_values(desc, subchart):
+        helm_cmd += ['--set', value]
+    _logger.debug('Running: %s', ' '.join(helm_cmd))
+    try:
+        helm_result = subprocess.run(helm_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError as e:
+        raise HelmError('helm not found. Please install helm and try again. %s' % e) from e
+    if helm_result.returncode != 0:
+        raise HelmError('helm template returned an error (code=%d): %s' % (
+            helm_result.returncode, helm_result.stderr.decode(errors='replace').strip()))
+    return helm_result.stdout.decode()
 
 
-def list_releases(namespace: str) -> list:
+def list_releases(core_api: kubernetes.client.CoreV1Api, namespace: str) -> list:
     """指定された名前空間でインストールされている Helm リリース一覧を取得する。
 
+    Helm 3 が Release ごとに保存している Secret を Kubernetes API で一括取得する。
+    Secret を読み取れない場合は helm list -o json の結果を使用する。
+
+    :param any core_api: Kubernetes core v1 API オブジェクト
     :param namespace: 名前空間
     :type namespace: str
-    :return: リリース一覧のリスト
+    :return: HelmRelease のリスト
     :rtype: list
     """
-    helm_cmd = ['helm', 'list', '-n', namespace]
+    from kubernetes.client.rest import ApiException
+
+    try:
+        secrets = []
+        token = None
+        while True:
+            kwargs = {'_continue': token} if token else {}
+            resp = core_api.list_namespaced_secret(namespace, label_selector=RELEASE_SECRET_SELECTOR,
+                                                   limit=RELEASE_LIST_LIMIT, **kwargs)
+            secrets.extend(resp.items)
+            token = resp.metadata._continue
+            if not token:
+                break
+        return releases_from_secrets(secrets)
+    except ApiException as e:
+        _logger.warning('Cannot read helm release secrets (%s). falling back to helm list', e.reason)
+    return list_releases_with_helm(namespace)
+
+
+def list_releases_with_helm(namespace: str) -> list:
+    """helm list -o json で指定された名前空間の Helm リリース一覧を取得する。
+
+    :return: HelmRelease のリスト
+    :rtype: list
+    :raises HelmError: helm が見つからない、または 0 以外の終了コードを返した場合
+    """
+    helm_cmd = ['helm', 'list', '-n', namespace, '--all', '--max', '0', '-o', 'json']
     _logger.info('Running: %s', ' '.join(helm_cmd))
     try:
-        # note: capture_output is available on python 3.7 or later
         helm_result = subprocess.run(helm_cmd, stdout=subprocess.PIPE)
-        _logger.info('Return code: %d', helm_result.returncode)
-        if helm_result.returncode != 0:
-            _logger.error('helm returned an error (code=%d). aborted.', helm_result.returncode)
-            raise HelmError
-        output_lines = helm_result.stdout.decode().splitlines()
-        result = []
-        # We expect a header line. so remove it by output_lines[1:]
-        for line in output_lines[1:]:
-            row = re.split(r'\s+', line)
-            result.append(row)
-        return result
     except FileNotFoundError as e:
-        _logger.exception('helm not found. Please install helm and try again. %s', e)
-        raise
+        raise HelmError('helm not found. Please install helm and try again. %s' % e) from e
+    _logger.info('Return code: %d', helm_result.returncode)
+    if helm_result.returncode != 0:
+        raise HelmError('helm returned an error (code=%d).' % helm_result.returncode)
+    return releases_from_json(helm_result.stdout.decode())
+
+
+def report_timeline(timeline: Timeline, desc: DeploymentDescriptor, trace_path: str = None) -> None:
+    """ステージごとの区間を subchart の区間から算出して記録し、所要時間の集計をログに出力する。
+
+    :param str trace_path: 指定された場合は Chrome trace 形式のファイルを書き出す
+    """
+    stages = {}
+    for s in timeline.spans('subchart'):
+        stage = s['args'].get('stage')
+        if stage is not None:
+            begin, end = stages.get(stage, (s['start'], s['end']))
+            stages[stage] = (min(begin, s['start']), max(end, s['end']))
+    for stage, (begin, end) in sorted(stages.items()):
+        timeline.add('stage %d' % stage, 'stage', begin, end)
+    for line in timeline.summary():
+        _logger.info('Timing: %s', line)
+    if trace_path:
+        timeline.write(trace_path)
+        _logger.info('Trace written to %s', trace_path)
 
 
 def main():
@@ -226,19 +540,6 @@ def main():
     args = parse_cmdline_args()
     _logger.debug('Parsed arguments: %s', args)
 
-    # 引数で指定された場合はその値を使い、そうでない場合はデフォルト値を使用
-    config_candidate = [args.config] if args.config else DEFAULT_KUBECONFIG
-
-    # config_candidate リストにあるファイルのどれかが読み込めるかチェックする
-    for kubepath in config_candidate:
-        if os.path.exists(kubepath):
-            _logger.info('Using kube config file: %s', kubepath)
-            config.load_kube_config(kubepath)
-            break
-    else:
-        _logger.error('Cannot read any of kubeconfig file(s): %s', config_candidate)
-        sys.exit(1)
-
     # 引数でデスクリプタが指定されている場合は読み込む
     if args.descriptor:
         try:
@@ -256,42 +557,185 @@ def main():
         desc.namespace = args.namespace
         _logger.info('Using namespace: %s', desc.namespace)
         desc.release_name = args.release
+
+    # --timeout はデスクリプタの readiness_timeout より優先する
+    if args.timeout is not None:
+        desc.readiness_timeout = args.timeout
     # _logger.debug('descriptor: %s', json.dumps(desc))
     _logger.debug('descriptor: %s', desc)
 
-    # 現在インストール済みのリリース一覧を取得し、名前を - で分割してサブチャート名を得る
-    helm_out = list_releases(desc.namespace)
-    installed_subcharts = []
-    for row in helm_out:
-        s = str(row[0]).split('-', maxsplit=1)
-        if len(s) >= 2:
-            installed_subcharts.append(s[1])
-    _logger.debug('installed subcharts: %s', installed_subcharts)
+    # 依存関係グラフを作成し、実行計画を出力する
+    try:
+        scheduler = DeployScheduler(desc.dependency_graph())
+    except ValueError as e:
+        _logger.error('Invalid dependencies in descriptor: %s', e)
+        sys.exit(1)
+    for line in scheduler.describe():
+        _logger.info('Plan: %s', line)
+    if args.plan:
+        return
 
-    # Kubernetes apps v1 クライアント作成
-    apps_v1 = client.AppsV1Api()
+    # 引数で指定された場合はその値を使い、そうでない場合はデフォルト値を使用
+    try:
+        kubepath = kubeclient.load_config(args.config)
+    except FileNotFoundError as e:
+        _logger.error('Cannot read kube config: %s', e)
+        sys.exit(1)
+    _logger.info('Using kube config file: %s', kubepath)
 
-    stage = 0
-    for subcharts in desc.deploy_order:
-        stage = stage + 1
-        _logger.debug('Stage %d: subcharts = %s', stage, subcharts)
+    # デプロイ記録を読み込み、チャートのバージョンを取得する。入力のハッシュ値が変化した subchart だけを再デプロイする。
+    # skip_deploy の場合はデプロイしないため、記録もチャートも参照しない
+    journal = None
+    version = None
+    if not args.skip_deploy:
+        try:
+            journal = DeployJournal(args.journal)
+            version = chart_version()
+        except (OSError, ValueError, HelmError) as e:
+            _logger.error('Failed to prepare deploy journal: %s', e)
+            sys.exit(1)
 
-        # Subchart をインストールする。skip_deploy が指定されている場合はスキップする。
-        if not args.skip_deploy:
-            for subchart in subcharts:
-                # 既にインストールされている場合はスキップ
-                if subchart in installed_subcharts:
-                    _logger.info('Deploying %s has been skipped because already installed', subchart)
-                    continue
-                _logger.info('Installing subchart %s ...', subchart)
-                deploy_subchart(desc, subchart)
+    # Kubernetes apps v1, core v1 クライアント作成。watch、Ready 待ち、先行取得の全スレッドで接続プールを共有する
+    apps_v1 = kubeclient.apps_api()
+    core_v1 = kubeclient.core_api()
+
+    # 現在インストール済みのリリース一覧を取得し、deployed 状態の subchart を得る
+    try:
+        releases = list_releases(core_v1, desc.namespace)
+    except HelmError as e:
+        _logger.error('Failed to list helm releases: %s', e)
+        sys.exit(1)
+    installed_subcharts = []
+    for release in releases:
+        subchart = release.subchart(desc.release_name)
+        if subchart is None:
+            continue
+        if release.status == 'deployed':
+            installed_subcharts.append(subchart)
         else:
-            _logger.info('Deploying subcharts has been skipped because skip_deploy is true')
+            _logger.info('Release %s is in %s state (revision %d)', release.name, release.status, release.revision)
+    _logger.debug('installed subcharts: %s', installed_subcharts)
 
-        # Deployments, StatefulSets が全て Ready になるまで待つ
-        for subchart in subcharts:
-            subchart_release_name = desc.release_name + '-' + subchart
-            wait_for_ready(apps_v1, desc.namespace, subchart_release_name)
+    # Namespace 全体のワークロードを 1 つのキャッシュで追跡し、全 subchart の Ready 判定で共有する
+    informer = create_informer(apps_v1, core_v1, desc.namespace, args.selector or desc.label_selector)
+
+    # ステージ、subchart、helm 実行、ワークロードの Ready 待ちの時刻を記録する
+    timeline = Timeline()
+
+    # ステージごとの開始時刻。ステージの制限時間は最初の subchart が開始した時点から数える
+    stage_started = {}
+    stage_lock = threading.Lock()
+
+    # helm deploy の同時実行数を制限する
+    helm_slots = threading.Semaphore(max(1, args.parallel))
+
+    # subchart の開始時に、その subchart に依存する subchart のイメージを先行取得する。
+    # 依存元の helm deploy と Ready 待ちの間に、次に開始する subchart のイメージ取得を済ませておく
+    prefetcher = None
+    prefetch_pool = None
+    prefetch_submitted = set()
+    prefetch_lock = threading.Lock()
+    dependents = {}
+    for name, deps in desc.dependency_graph().items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(name)
+    if args.prefetch and not args.skip_deploy:
+        prefetcher = ImagePrefetcher(apps_v1, informer, desc.namespace)
+        prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_PARALLEL,
+                                                              thread_name_prefix='prefetch')
+
+    def is_unchanged(subchart: str) -> bool:
+        release = desc.release_name + '-' + subchart
+        digest = input_digest(desc.base_override, helm_set_values(desc, subchart), version)
+        return subchart in installed_subcharts and journal.is_unchanged(desc.namespace, release, digest)
+
+    def prefetch_images(subchart: str) -> None:
+        """subchart のマニフェストに含まれるイメージを全ノードで先行取得する。失敗してもデプロイは続行する。
+        """
+        release = desc.release_name + '-' + subchart
+        try:
+            # 入力が変化していない subchart はデプロイしないため、先行取得も不要
+            if is_unchanged(subchart):
+                return
+            with timeline.span('prefetch %s' % release, 'prefetch', release):
+                images, pull_secrets = images_from_manifests(render_manifests(desc, subchart))
+                _logger.info('Prefetching %d image(s) of %s', len(images), subchart)
+                prefetcher.prefetch(prefetch_name(release), images, pull_secrets)
+        except Exception as e:
+            _logger.warning('Prefetching images of %s failed: %s', subchart, e)
+
+    def schedule_prefetch(subchart: str) -> None:
+        if prefetcher is None:
+            return
+        with prefetch_lock:
+            targets = [name for name in dependents.get(subchart, []) if name not in prefetch_submitted]
+            prefetch_submitted.update(targets)
+        for name in targets:
+            prefetch_pool.submit(prefetch_images, name)
+
+    def install_and_wait(subchart: str) -> None:
+        """subchart をインストールし、Deployments, StatefulSets が全て Ready になるまで待つ。
+        """
+        deadline = None
+        if desc.stage_timeout:
+            with stage_lock:
+                started = stage_started.setdefault(desc.stage_of(subchart) or subchart, time.monotonic())
+            deadline = started + desc.stage_timeout
+        release = desc.release_name + '-' + subchart
+        digest = None
+        unchanged = False
+        if not args.skip_deploy:
+            digest = input_digest(desc.base_override, helm_set_values(desc, subchart), version)
+            unchanged = subchart in installed_subcharts and journal.is_unchanged(desc.namespace, release, digest)
+        # 開始済みの subchart のイメージは kubelet が取得するため、先行取得は依存元の subchart だけを対象とする
+        with prefetch_lock:
+            prefetch_submitted.add(subchart)
+        schedule_prefetch(subchart)
+        with timeline.span(subchart, 'subchart', release, stage=desc.stage_of(subchart)):
+            # Subchart をインストールする。skip_deploy が指定されている場合や入力が変化していない場合はスキップする。
+            if args.skip_deploy:
+                _logger.info('Deploying %s has been skipped because skip_deploy is true', subchart)
+            elif unchanged:
+                _logger.info('Deploying %s has been skipped because its inputs are unchanged', subchart)
+                # 前回 Ready を確認済みで、キャッシュ上も Ready であれば待機しない
+                if journal.get(desc.namespace, release).get('ready') and release_ready(informer, release):
+                    _logger.info('Subchart %s is ready (confirmed from cache)', subchart)
+                    return
+            else:
+                if subchart in installed_subcharts:
+                    _logger.info('Inputs of %s have changed since the last deploy. upgrading', subchart)
+                with timeline.span('wait for helm slot', 'helm-queue', release):
+                    helm_slots.acquire()
+                try:
+                    with timeline.span('helm deploy %s' % release, 'helm', release):
+                        _logger.info('Installing subchart %s ...', subchart)
+                        deploy_subchart(desc, subchart)
+                finally:
+                    helm_slots.release()
+                journal.record(desc.namespace, release, digest, version, ready=False)
+            with timeline.span('wait for %s' % release, 'wait', release):
+                wait_for_ready(informer, release, desc.readiness_timeout, deadline, args.fail_grace, timeline)
+            record_image_pulls(informer, timeline, release)
+            if not args.skip_deploy:
+                journal.record(desc.namespace, release, digest, version, ready=True)
+        _logger.info('Subchart %s is ready', subchart)
+
+    # 各 subchart は自身の依存先が全て Ready になった時点でデプロイを開始する
+    try:
+        done, failures, skipped = scheduler.run(install_and_wait)
+    finally:
+        if prefetcher is not None:
+            prefetcher.cleanup()
+            prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        informer.stop()
+        report_timeline(timeline, desc, args.trace)
+    _logger.info('Deployed %d subchart(s): %s', len(done), done)
+    if failures or skipped:
+        for subchart, error in failures.items():
+            _logger.error('%s failed: %s', subchart, error)
+        if skipped:
+            _logger.error('Not deployed because of failed dependencies: %s', skipped)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+# ---------------------------------------------------------------------------
+# helmrelease.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import base64
+import functools
+import gzip
+import json
+
+# Helm 3 が Release の情報を保存する Secret のラベルセレクタ。
+# 過去のリビジョン (superseded) を除外して、各 Release の最新リビジョンだけを取得する
+RELEASE_SECRET_SELECTOR = 'owner=helm,status!=superseded'
+
+# gzip 圧縮されたデータの先頭バイト列
+_GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+class HelmRelease:
+    """Helm の Release 1 件の情報"""
+    def __init__(self, name: str, namespace: str, revision: int, status: str, chart: str = None,
+                 app_version: str = None, updated: str = None, payload: str = None):
+        """
+        :param str payload: Release の Secret の 'release' キーの値 (base64)。chart などが省略された場合に展開して使用する
+        """
+        self.name = name
+        self.namespace = namespace
+        self.revision = revision
+        self.status = status
+        self._chart = chart
+        self._app_version = app_version
+        self._updated = updated
+        self._payload = payload
+
+    @functools.cached_property
+    def _decoded(self) -> dict:
+        """Secret のデータを展開した Release の内容を返す。必要になるまで展開しない。
+        """
+        if not self._payload:
+            return {}
+        # Secret のデータ (base64) の中身は、Helm がさらに base64 でエンコードした gzip 圧縮済みの JSON
+        data = base64.b64decode(base64.b64decode(self._payload))
+        if data.startswith(_GZIP_MAGIC):
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+    @property
+    def chart(self) -> str:
+        if self._chart is None:
+            metadata = self._decoded.get('chart', {}).get('metadata', {})
+            self._chart = '%s-%s' % (metadata.get('name', ''), metadata.get('version', ''))
+        return self._chart
+
+    @property
+    def app_version(self) -> str:
+        if self._app_version is None:
+            self._app_version = self._decoded.get('chart', {}).get('metadata', {}).get('appVersion', '')
+        return self._app_version
+
+    @property
+    def updated(self) -> str:
+        if self._updated is None:
+            self._updated = self._decoded.get('info', {}).get('last_deployed', '')
+        return self._updated
+
+    def subchart(self, release_prefix: str) -> str:
+        """'<release_prefix>-<subchart>' という名前の Release であれば subchart 名を返す。そうでない場合は None を返す。
+        """
+        prefix = release_prefix + '-'
+        if self.name.startswith(prefix) and len(self.name) > len(prefix):
+            return self.name[len(prefix):]
+        return None
+
+    def __repr__(self):
+        return 'HelmRelease(name=%s, namespace=%s, revision=%d, status=%s)' % (
+            self.name, self.namespace, self.revision, self.status)
+
+
+def releases_from_secrets(secrets: list) -> list:
+    """Helm の Release の Secret (V1Secret) のリストから、Release ごとに最新のリビジョンを返す。
+
+    name, status, version はラベルから取得するため、Release の内容は展開しない。
+    """
+    latest = {}
+    for secret in secrets:
+        labels = secret.metadata.labels or {}
+        if labels.get('owner') != 'helm' or 'name' not in labels:
+            continue
+        release = HelmRelease(labels['name'], secret.metadata.namespace, int(labels.get('version', 0)),
+                              labels.get('status', ''), payload=(secret.data or {}).get('release'))
+        current = latest.get((release.namespace, release.name))
+        if current is None or current.revision < release.revision:
+            latest[(release.namespace, release.name)] = release
+    return sorted(latest.values(), key=lambda r: (r.namespace, r.name))
+
+
+def releases_from_json(text: str) -> list:
+    """helm list -o json の出力から Release のリストを返す。
+    """
+    return [HelmRelease(x['name'], x['namespace'], int(x['revision']), x['status'], x.get('chart', ''),
+                        x.get('app_version', ''), x.get('updated', ''))
+            for x in json.loads(text or '[]') or []]
@@ -0,0 +1,325 @@
+# ---------------------------------------------------------------------------
+# informer.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import functools
+import logging
+import socket
+import threading
+import time
+
+# Helm が各オブジェクトに付与する Release 名の annotation
+RELEASE_ANNOTATION = 'meta.helm.sh/release-name'
+
+# watch ストリーム 1 本あたりのタイムアウト秒数。タイムアウト後は最後に受け取った resourceVersion から再開する
+WATCH_TIMEOUT = 300
+
+# API エラー時に list + watch をやり直すまでの待ち時間 (秒)
+RETRY_INTERVAL = 5
+
+# stop() で各スレッドの終了を待つ最大秒数
+STOP_TIMEOUT = 5
+
+_logger = logging.getLogger(__name__)
+
+
+def release_of(obj) -> str:
+    """オブジェクトを生成した Helm の Release 名を返す。Helm 管理外の場合は None を返す。
+    """
+    annotations = obj.metadata.annotations or {}
+    return annotations.get(RELEASE_ANNOTATION)
+
+
+def event_time(event):
+    """Event の発生時刻を返す。時刻が記録されていない場合は作成時刻を使用する。
+    """
+    return event.last_timestamp or event.event_time or event.metadata.creation_timestamp
+
+
+def selector_matches(selector, labels: dict) -> bool:
+    """ラベルセレクタ (V1LabelSelector) が labels に一致するかを返す。matchLabels と matchExpressions の両方を評価する。
+
+    条件を 1 つも持たないセレクタは何にも一致しないものとして扱う。ワークロードのセレクタとしては無効であり、
+    Namespace 内の全ての Pod に一致させないため。
+    """
+    match_labels = (selector.match_labels if selector is not None else None) or {}
+    expressions = (selector.match_expressions if selector is not None else None) or []
+    if not match_labels and not expressions:
+        return False
+    labels = labels or {}
+    if not match_labels.items() <= labels.items():
+        return False
+    for expr in expressions:
+        values = expr.values or []
+        if expr.operator == 'In':
+            matched = labels.get(expr.key) in values
+        elif expr.operator == 'NotIn':
+            matched = labels.get(expr.key) not in values
+        elif expr.operator == 'Exists':
+            matched = expr.key in labels
+        elif expr.operator == 'DoesNotExist':
+            matched = expr.key not in labels
+        else:
+            matched = False
+        if not matched:
+            return False
+    return True
+
+
+def _interrupt(resp) -> None:
+    """別のスレッドで読み取り中の HTTP 応答の接続を切断し、読み取りを中断させる。"""
+    try:
+        # urllib3 2.3 以降は shutdown() を使う。接続が既に解放されている場合は ValueError になる
+        resp.shutdown()
+        return
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        sock = getattr(getattr(resp, 'connection', None), 'sock', None)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class NamespaceInformer:
+    """Namespace 内のオブジェクトを list + watch で追跡するインメモリ・キャッシュ。
+
+    種別ごとに 1 本の watch でキャッシュを最新に保ち、Helm の Release 名で索引付けする。
+    読み出しは全てキャッシュから行うため、呼び出し回数によらず API サーバへの問い合わせは増えない。
+    """
+    def __init__(self, namespace: str, sources: dict, label_selector: str = None, selector_kinds: list = None):
+        """
+        :param str namespace: 対象の Namespace
+        :param dict sources: 種別名をキー、list_namespaced_deployment などの一覧取得関数を値とする辞書
+        :param str label_selector: サーバ側で絞り込むためのラベルセレクタ
+        :param list selector_kinds: label_selector を適用する種別名のリスト。省略時は全ての種別に適用する
+        """
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.selector_kinds = set(sources if selector_kinds is None else selector_kinds)
+        self._sources = dict(sources)
+        self._cond = threading.Condition()
+        self._stores = {kind: {} for kind in self._sources}
+        self._releases = {kind: {} for kind in self._sources}
+        self._versions = {kind: 0 for kind in self._sources}
+        self._synced = set()
+        self._stopped = threading.Event()
+        self._watches = {}
+        self._responses = {}
+        self._threads = []
+
+    def start(self) -> None:
+        """種別ごとに list + watch を行うスレッドを開始する。
+        """
+        for kind, list_func in self._sources.items():
+            t = threading.Thread(target=self._run, args=(kind, list_func), name='informer-%s' % kind, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self) -> None:
+        """全ての watch を停止し、スレッドの終了を待つ。
+
+        watch のスレッドはソケットの読み取りで最大 WATCH_TIMEOUT 秒止まっているため、応答の接続を切断して読み取りを
+        中断させる。通信中のスレッドを残したままインタプリタが終了すると、終了処理で異常終了することがある。
+        """
+        self._stopped.set()
+        with self._cond:
+            watches = list(self._watches.values())
+            responses = list(self._responses.values())
+        for w in watches:
+            w.stop()
+        for resp in responses:
+            _interrupt(resp)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for t in self._threads:
+            if t is not threading.current_thread():
+                t.join(max(0.0, deadline - time.monotonic()))
+        alive = [t.name for t in self._threads if t.is_alive()]
+        if alive:
+            _logger.warning('informer thread(s) did not stop in %d seconds: %s', STOP_TIMEOUT, ', '.join(alive))
+
+    def _watch_func(self, kind: str, list_func):
+        """watch の応答を stop() から切断できるよう記録する一覧取得関数を返す。"""
+        @functools.wraps(list_func)
+        def func(*args, **kwargs):
+            resp = list_func(*args, **kwargs)
+            with self._cond:
+                self._responses[kind] = resp
+                stopped = self._stopped.is_set()
+            if stopped:
+                # stop() が応答を記録する前に呼ばれた場合
+                _interrupt(resp)
+            return resp
+        return func
+
+    def _selector_args(self, kind: str) -> dict:
+        if self.label_selector and kind in self.selector_kinds:
+            return {'label_selector': self.label_selector}
+        return {}
+
+    def _replace(self, kind: str, items: list) -> None:
+        with self._cond:
+            self._stores[kind] = {}
+            self._releases[kind] = {}
+            for obj in items:
+                self._put(kind, obj)
+            self._versions[kind] += 1
+            self._synced.add(kind)
+            self._cond.notify_all()
+
+    def _put(self, kind: str, obj) -> None:
+        name = obj.metadata.name
+        self._delete(kind, name)
+        self._stores[kind][name] = obj
+        release = release_of(obj)
+        if release is not None:
+            self._releases[kind].setdefault(release, set()).add(name)
+
+    def _delete(self, kind: str, name: str) -> None:
+        old = self._stores[kind].pop(name, None)
+        if old is not None:
+            names = self._releases[kind].get(release_of(old))
+            if names is not None:
+                names.discard(name)
+
+    def _run(self, kind: str, list_func) -> None:
+        """一覧を取得してキャッシュを置き換えた後、その resourceVersion から watch を続ける。
+        """
+        from kubernetes import watch
+        from kubernetes.client.rest import ApiException
+
+        watch_func = self._watch_func(kind, list_func)
+        while not self._stopped.is_set():
+            try:
+                resp = list_func(self.namespace, **self._selector_args(kind))
+                self._replace(kind, resp.items)
+                resource_version = resp.metadata.resource_version
+                _logger.debug('%s: listed %d object(s) at resourceVersion %s', kind, len(resp.items),
+                              resource_version)
+                while not self._stopped.is_set():
+                    w = watch.Watch()
+                    self._watches[kind] = w
+                    expired = False
+                    for event in w.stream(watch_func, self.namespace, resource_version=resource_version,
+                                          timeout_seconds=WATCH_TIMEOUT, allow_watch_bookmarks=True,
+                                          **self._selector_args(kind)):
+                        if event['type'] == 'ERROR':
+                            # 410 Gone など。一覧を取り直す
+                            _logger.debug('%s: watch error: %s', kind, event.get('raw_object'))
+                            expired = True
+                            break
+                        if event['type'] == 'BOOKMARK':
+                            continue
+                        obj = event['object']
+                        with self._cond:
+                            if event['type'] == 'DELETED':
+                                self._delete(kind, obj.metadata.name)
+                            else:
+                                self._put(kind, obj)
+                            self._versions[kind] += 1
+                            self._cond.notify_all()
+                    w.stop()
+                    with self._cond:
+                        self._responses.pop(kind, None)
+                    if expired:
+                        break
+                    resource_version = w.resource_version or resource_version
+            except ApiException as e:
+                if e.status != 410:
+                    _logger.warning('%s: API error while watching (%s). retrying in %d seconds', kind, e.reason,
+                                    RETRY_INTERVAL)
+                    self._stopped.wait(RETRY_INTERVAL)
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                _logger.warning('%s: watch failed (%s). retrying in %d seconds', kind, e, RETRY_INTERVAL)
+                self._stopped.wait(RETRY_INTERVAL)
+
+    def wait_for_sync(self, timeout: float = None) -> bool:
+        """全ての種別の初回一覧取得が完了するまで待機する。
+
+        :return: タイムアウトまでに完了した場合は True
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._synced >= self._sources.keys(), timeout)
+
+    def kinds(self) -> list:
+        """追跡している種別名のリストを返す。
+        """
+        return list(self._sources)
+
+    def version(self, kind: str) -> int:
+        """指定種別のキャッシュの変更回数を返す。値が変わっていなければ、その種別のオブジェクトは変化していない。
+        """
+        with self._cond:
+            return self._versions[kind]
+
+    def get(self, kind: str, name: str):
+        """キャッシュされているオブジェクトを返す。存在しない場合は None を返す。
+        """
+        with self._cond:
+            return self._stores[kind].get(name)
+
+    def list(self, kind: str) -> list:
+        """キャッシュされている指定種別のオブジェクトを返す。
+        """
+        with self._cond:
+            return list(self._stores[kind].values())
+
+    def by_release(self, release_name: str, kinds: list = None) -> list:
+        """指定された Release で生成されたオブジェクトを (種別名, オブジェクト) のリストで返す。
+        """
+        result = []
+        with self._cond:
+            for kind in kinds or self._sources:
+                for name in sorted(self._releases[kind].get(release_name, ())):
+                    result.append((kind, self._stores[kind][name]))
+        return result
+
+    def select(self, kind: str, match_labels: dict) -> list:
+        """指定されたラベルを全て持つオブジェクトをキャッシュから返す。
+        """
+        match_labels = match_labels or {}
+        with self._cond:
+            return [obj for obj in self._stores[kind].values()
+                    if match_labels.items() <= (obj.metadata.labels or {}).items()]
+
+    def select_by(self, kind: str, selector) -> list:
+        """ラベルセレクタ (V1LabelSelector) に一致するオブジェクトをキャッシュから返す。selector_matches を参照。
+        """
+        with self._cond:
+            return [obj for obj in self._stores[kind].values() if selector_matches(selector, obj.metadata.labels)]
+
+    def events_for(self, kind: str, name: str) -> list:
+        """キャッシュされている Event のうち、指定されたオブジェクトに関するものを古い順に返す。
+
+        'Event' 種別を追跡している場合のみ使用できる。
+        """
+        with self._cond:
+            events = [e for e in self._stores['Event'].values()
+                      if e.involved_object.kind == kind and e.involved_object.name == name]
+        return sorted(events, key=event_time)
+
+    def wait_until(self, predicate, timeout: float = None):
+        """キャッシュが更新されるたびに predicate を評価し、真になるまで待機する。
+
+        predicate はキャッシュのロックを保持した状態で呼び出される。
+
+        :return: predicate の最後の評価結果
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            result = predicate()
+            while not result:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                result = predicate()
+            return result
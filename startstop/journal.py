@@ -0,0 +1,84 @@
+# ---------------------------------------------------------------------------
+# journal.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def input_digest(override_path: str, set_values: list, chart_version: str) -> str:
+    """デプロイの入力 (override ファイルの内容, --set の値, チャートのバージョン) のハッシュ値を返す。
+
+    :param str override_path: override ファイルのパス
+    :param list set_values: helm に --set で渡す 'key=value' のリスト
+    :param str chart_version: チャートのバージョン
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(override_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    for value in sorted(set_values):
+        h.update(b'\0' + value.encode())
+    h.update(b'\0' + str(chart_version).encode())
+    return h.hexdigest()
+
+
+class DeployJournal:
+    """Release ごとに最後にデプロイした入力のハッシュ値と、Ready を確認したかどうかを記録するファイル。
+
+    次回以降の実行では、入力が変化した Release だけを再デプロイするために使用する。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f).get('releases', {})
+
+    @staticmethod
+    def _key(namespace: str, release: str) -> str:
+        return '%s/%s' % (namespace, release)
+
+    def get(self, namespace: str, release: str) -> dict:
+        """記録されている Release の情報を返す。記録が無い場合は None を返す。
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(namespace, release))
+            return dict(entry) if entry else None
+
+    def is_unchanged(self, namespace: str, release: str, digest: str) -> bool:
+        """最後にデプロイした時から入力が変化していないかどうかを返す。
+        """
+        entry = self.get(namespace, release)
+        return entry is not None and entry.get('digest') == digest
+
+    def record(self, namespace: str, release: str, digest: str, chart_version: str, ready: bool) -> None:
+        """Release のデプロイ結果を記録し、ファイルに保存する。
+        """
+        with self._lock:
+            self._entries[self._key(namespace, release)] = {
+                'digest': digest,
+                'chart_version': chart_version,
+                'ready': ready,
+                'updated': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            }
+            self._save()
+
+    def _save(self) -> None:
+        # 書き込み途中で中断されても壊れないよう、一時ファイルに書いてから置き換える
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'releases': self._entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,139 @@
+# ---------------------------------------------------------------------------
+# kubeclient.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import os
+import re
+import threading
+
+# kubernetes パッケージは読み込みに 1 秒近くかかるため、--help や --plan など API を使わない処理では読み込まない。
+# このモジュールの関数を最初に呼び出した時点で読み込む
+
+# ホームディレクトリの取得
+if os.name == 'nt':
+    # Windows の場合は USERPROFILE 環境変数を使用
+    home_dir = os.environ.get('USERPROFILE', '')
+else:
+    home_dir = os.environ.get('HOME', '')
+
+# --config オプションが指定されなかった時にデフォルトで検索する kubeconfig ファイルのパス
+# KUBECONFIG 環境変数が空であった場合は取り除くために filter を使用
+DEFAULT_KUBECONFIG = list(filter(None, [
+    os.path.join(os.path.curdir, 'kubeconfig'),
+    os.environ.get('KUBECONFIG', ''),
+    os.path.join(home_dir, '.kube', 'config')
+]))
+
+# 接続プールに保持する接続数の既定値。同時に API を呼び出すスレッド数以上にする
+DEFAULT_POOL_SIZE = 16
+
+# API 呼び出しの接続、応答の読み取りの制限時間の既定値 (秒)
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# watch の要求の URL に含まれるクエリ
+_WATCH_QUERY = re.compile(r'[?&]watch=(?:true|1)(?:&|$)', re.IGNORECASE)
+
+_lock = threading.Lock()
+_loaded_config = None
+_api_clients = {}
+
+
+def load_config(path: str = None) -> str:
+    """kubeconfig を読み込む。2 回目以降の呼び出しでは読み込まず、最初に読み込んだファイルのパスを返す。
+
+    :param str path: kubeconfig ファイルのパス。None の場合は DEFAULT_KUBECONFIG のうち最初に存在するファイル
+    :return: 読み込んだ kubeconfig ファイルのパス
+    :rtype: str
+    :raises FileNotFoundError: 候補のファイルがどれも存在しない場合
+    """
+    global _loaded_config
+    with _lock:
+        if _loaded_config is not None:
+            return _loaded_config
+        config_candidate = [path] if path else DEFAULT_KUBECONFIG
+        # config_candidate リストにあるファイルのどれかが読み込めるかチェックする
+        for kubepath in config_candidate:
+            if os.path.exists(kubepath):
+                from kubernetes import config
+                config.load_kube_config(kubepath)
+                _loaded_config = kubepath
+                return kubepath
+        raise FileNotFoundError('cannot read any of kubeconfig file(s): %s' % config_candidate)
+
+
+def _is_watch(args: tuple) -> bool:
+    """call_api の引数が watch の要求かどうかを返す。
+
+    kubernetes 37 以降はクエリを含む URL を、それより前は (名前, 値) のリストの query_params を位置引数で渡す。
+    """
+    for value in args:
+        if isinstance(value, str) and _WATCH_QUERY.search(value):
+            return True
+        if isinstance(value, list) and any(isinstance(p, tuple) and len(p) == 2 and p[0] == 'watch' and p[1]
+                                           for p in value):
+            return True
+    return False
+
+
+def _create_api_client(configuration, timeout: tuple):
+    from kubernetes import client
+
+    class PooledApiClient(client.ApiClient):
+        """_request_timeout が指定されない API 呼び出しに、既定の制限時間を適用する ApiClient
+
+        call_api の引数の並びは client の生成方式によって異なるため、キーワード引数の _request_timeout だけを扱う。
+        """
+        def call_api(self, *args, **kwargs):
+            if kwargs.get('_request_timeout') is None:
+                # watch はイベントが無い間も応答を待ち続けるため、読み取りの制限時間は適用しない
+                kwargs['_request_timeout'] = (timeout[0], None) if _is_watch(args) else timeout
+            return super().call_api(*args, **kwargs)
+
+    return PooledApiClient(configuration)
+
+
+def api_client(pool_size: int = DEFAULT_POOL_SIZE, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+               read_timeout: float = DEFAULT_READ_TIMEOUT):
+    """接続プールを持つ ApiClient を返す。同じ引数に対しては同じオブジェクトを返し、スレッド間で接続を使い回す。
+
+    load_config を呼び出した後に使用すること。
+
+    :param int pool_size: 接続プールに保持する接続数
+    :param float connect_timeout: 接続の制限時間 (秒)
+    :param float read_timeout: 応答の読み取りの制限時間 (秒)。watch には適用しない
+    :rtype: kubernetes.client.ApiClient
+    """
+    key = (max(pool_size, 1), connect_timeout, read_timeout)
+    with _lock:
+        if _loaded_config is None:
+            raise RuntimeError('load_config() must be called before creating an API client')
+        if key not in _api_clients:
+            from kubernetes import client
+            configuration = client.Configuration.get_default_copy()
+            configuration.connection_pool_maxsize = key[0]
+            _api_clients[key] = _create_api_client(configuration, (connect_timeout, read_timeout))
+        return _api_clients[key]
+
+
+def apps_api(**kwargs):
+    """接続プールを共有する apps v1 API オブジェクトを返す。引数は api_client と同じ。
+
+    :rtype: kubernetes.client.AppsV1Api
+    """
+    from kubernetes import client
+    return client.AppsV1Api(api_client(**kwargs))
+
+
+def core_api(**kwargs):
+    """接続プールを共有する core v1 API オブジェクトを返す。引数は api_client と同じ。
+
+    :rtype: kubernetes.client.CoreV1Api
+    """
+    from kubernetes import client
+    return client.CoreV1Api(api_client(**kwargs))
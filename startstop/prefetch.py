@@ -0,0 +1,208 @@
+# ---------------------------------------------------------------------------
+# prefetch.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import typing
+
+import yaml
+
+from informer import NamespaceInformer
+
+if typing.TYPE_CHECKING:
+    from kubernetes import client
+
+# 先行取得用の DaemonSet と Pod に付与するラベル。値は DaemonSet 名
+PREFETCH_LABEL = 'onap-deploy/prefetch'
+
+# 全ノードでのイメージ取得を待つ最大秒数。超えた場合は先行取得を打ち切り、取得は kubelet に任せる
+PREFETCH_TIMEOUT = 900
+
+# DaemonSet の状態を再確認する間隔 (秒)
+RECHECK_INTERVAL = 10
+
+# コンテナがこれらの理由で待機している場合は、そのイメージの取得に失敗したとみなす
+PULL_FAILURE_REASONS = {'ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull'}
+
+# コンテナがこれらの理由で待機している場合は、コマンドを実行できなかっただけでイメージは取得済みとみなす。
+# シェルや sleep を含まないイメージ (distroless など) のコンテナはこの状態になる
+CONTAINER_FAILURE_REASONS = {'RunContainerError', 'CreateContainerError', 'CrashLoopBackOff'}
+
+# Pod テンプレートを含むリソースの種類と、Pod spec までのパス
+_POD_SPEC_PATHS = {
+    'Deployment': ['spec', 'template', 'spec'],
+    'StatefulSet': ['spec', 'template', 'spec'],
+    'DaemonSet': ['spec', 'template', 'spec'],
+    'ReplicaSet': ['spec', 'template', 'spec'],
+    'Job': ['spec', 'template', 'spec'],
+    'CronJob': ['spec', 'jobTemplate', 'spec', 'template', 'spec'],
+    'Pod': ['spec'],
+}
+
+_logger = logging.getLogger(__name__)
+
+
+def images_from_manifests(text: str) -> tuple:
+    """helm template の出力 (複数ドキュメントの YAML) から、コンテナイメージと imagePullSecrets を取り出す。
+
+    :return: (イメージ名のリスト, imagePullSecrets の Secret 名のリスト)。どちらも重複を除いて出現順
+    :rtype: tuple
+    """
+    images = {}
+    pull_secrets = {}
+    for doc in yaml.safe_load_all(text):
+        if not isinstance(doc, dict) or doc.get('kind') not in _POD_SPEC_PATHS:
+            continue
+        spec = doc
+        for key in _POD_SPEC_PATHS[doc['kind']]:
+            spec = (spec or {}).get(key)
+        spec = spec or {}
+        for container in (spec.get('initContainers') or []) + (spec.get('containers') or []):
+            if container.get('image'):
+                images.setdefault(container['image'], None)
+        for secret in spec.get('imagePullSecrets') or []:
+            if secret.get('name'):
+                pull_secrets.setdefault(secret['name'], None)
+    return list(images), list(pull_secrets)
+
+
+def prefetch_name(release_name: str) -> str:
+    """Release のイメージを先行取得する DaemonSet の名前を返す。"""
+    return ('prefetch-' + release_name)[:63].rstrip('-')
+
+
+class ImagePrefetcher:
+    """DaemonSet を使って、各ノードにコンテナイメージを先行取得させる。
+
+    イメージごとに何もしないコンテナを 1 つ持つ DaemonSet を作成し、全ノードの Pod で各コンテナのイメージが
+    取得された (imageID が設定された) 時点で DaemonSet を削除する。コマンドはシェルを使わずに sleep を直接実行する。
+    sleep を含まないイメージではコンテナを起動できず再起動を繰り返すが、イメージの取得は完了しているため
+    取得済みとして扱う。
+    """
+    def __init__(self, apps_api: client.AppsV1Api, informer: NamespaceInformer, namespace: str,
+                 timeout: float = PREFETCH_TIMEOUT):
+        """
+        :param NamespaceInformer informer: namespace の Pod を追跡しているキャッシュ
+        """
+        self.apps_api = apps_api
+        self.informer = informer
+        self.namespace = namespace
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._created = set()
+        self._stopped = threading.Event()
+
+    def _daemonset(self, name: str, images: list, pull_secrets: list) -> client.V1DaemonSet:
+        from kubernetes import client
+
+        labels = {PREFETCH_LABEL: name}
+        containers = [{'name': 'image-%d' % i, 'image': image, 'imagePullPolicy': 'IfNotPresent',
+                       'command': ['sleep', '86400'],
+                       'resources': {'requests': {'cpu': '1m', 'memory': '4Mi'}}}
+                      for i, image in enumerate(images)]
+        return client.V1DaemonSet.from_dict({
+            'apiVersion': 'apps/v1', 'kind': 'DaemonSet',
+            'metadata': {'name': name, 'labels': labels},
+            'spec': {'selector': {'matchLabels': labels},
+                     'template': {'metadata': {'labels': labels},
+                                  'spec': {'containers': containers, 'terminationGracePeriodSeconds': 0,
+                                           'imagePullSecrets': [{'name': s} for s in pull_secrets]}}},
+        })
+
+    def _progress(self, name: str, images: list) -> tuple:
+        """(取得が終わった Pod 数, 対象の Pod 数, 取得に失敗したイメージの集合) を返す。"""
+        pods = self.informer.select('Pod', {PREFETCH_LABEL: name})
+        done = 0
+        failed = set()
+        for pod in pods:
+            statuses = (pod.status.container_statuses if pod.status else None) or []
+            finished = 0
+            for status in statuses:
+                waiting = status.state.waiting if status.state else None
+                if waiting is not None and waiting.reason in PULL_FAILURE_REASONS:
+                    failed.add(status.image)
+                    finished += 1
+                elif status.image_id or (waiting is not None and waiting.reason in CONTAINER_FAILURE_REASONS):
+                    finished += 1
+            if finished >= len(images):
+                done += 1
+        return done, len(pods), failed
+
+    def prefetch(self, name: str, images: list, pull_secrets: list = None) -> bool:
+        """全ノードで images を取得させ、完了するか制限時間を過ぎるまで待機する。
+
+        :param str name: DaemonSet の名前
+        :return: 全ノードで全てのイメージを取得できた場合は True
+        :rtype: bool
+        """
+        from kubernetes.client.rest import ApiException
+
+        if not images:
+            return True
+        # 作成の応答を受け取れなかった場合も削除できるよう、作成前に記録する
+        with self._lock:
+            self._created.add(name)
+        try:
+            try:
+                self.apps_api.create_namespaced_daemon_set(self.namespace, self._daemonset(name, images,
+                                                                                           pull_secrets or []))
+            except ApiException as e:
+                if e.status != 409:
+                    raise
+                _logger.info('Prefetch %s: DaemonSet already exists. reusing it', name)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                # 対象ノード数は DaemonSet の status から得る。キャッシュの更新が無くても定期的に読み直す
+                status = self.apps_api.read_namespaced_daemon_set_status(name, self.namespace).status
+                desired = (status.desired_number_scheduled or 0) if status else 0
+
+                def finished() -> bool:
+                    return self._stopped.is_set() or (desired > 0 and self._progress(name, images)[0] >= desired)
+
+                remaining = deadline - time.monotonic()
+                if self.informer.wait_until(finished, max(0.0, min(RECHECK_INTERVAL, remaining))):
+                    break
+                if remaining <= 0:
+                    _logger.warning('Prefetch %s: timed out (%d of %d node(s) done)', name,
+                                    self._progress(name, images)[0], desired)
+                    return False
+            if self._stopped.is_set():
+                return False
+            done, total, failed = self._progress(name, images)
+            if failed:
+                _logger.warning('Prefetch %s: failed to pull %s', name, ', '.join(sorted(failed)))
+                return False
+            _logger.info('Prefetch %s: %d image(s) pulled on %d node(s)', name, len(images), done)
+            return True
+        finally:
+            self.delete(name)
+
+    def delete(self, name: str) -> None:
+        """先行取得用の DaemonSet を削除する。Pod の削除は待たない。"""
+        from kubernetes.client.rest import ApiException
+
+        try:
+            self.apps_api.delete_namespaced_daemon_set(name, self.namespace, propagation_policy='Background',
+                                                       grace_period_seconds=0)
+        except ApiException as e:
+            if e.status != 404:
+                _logger.warning('Prefetch %s: failed to delete DaemonSet (%s)', name, e.reason)
+        with self._lock:
+            self._created.discard(name)
+
+    def cleanup(self) -> None:
+        """実行中の先行取得を打ち切り、削除されずに残っている先行取得用の DaemonSet を全て削除する。"""
+        self._stopped.set()
+        with self._lock:
+            names = list(self._created)
+        for name in names:
+            self.delete(name)
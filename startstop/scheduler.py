@@ -0,0 +1,135 @@
+# ---------------------------------------------------------------------------
+# scheduler.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import concurrent.futures
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class DeployScheduler:
+    """subchart の依存関係グラフに従ってデプロイ処理を実行するスケジューラ。
+
+    各 subchart は自身の依存先が全て完了した時点で開始される。依存先が失敗した subchart は実行されない。
+    """
+    def __init__(self, graph: dict):
+        """
+        :param dict graph: subchart 名をキー、依存先 subchart 名の集合を値とする辞書
+        :raises ValueError: 未定義の subchart への依存や循環依存がある場合
+        """
+        self.graph = {name: set(deps) for name, deps in graph.items()}
+        for name, deps in self.graph.items():
+            unknown = deps - self.graph.keys()
+            if unknown:
+                raise ValueError('%s depends on unknown subchart(s): %s' % (name, sorted(unknown)))
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> list:
+        """依存先が先に来るように並べた subchart のリストを返す。
+
+        :raises ValueError: 循環依存がある場合
+        """
+        order = []
+        remaining = {name: set(deps) for name, deps in self.graph.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError('circular dependency among subcharts: %s' % sorted(remaining))
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def levels(self) -> dict:
+        """各 subchart の深さ (依存の連鎖の長さ, 1 始まり) を返す。
+        """
+        level = {}
+        for name in self.order:
+            level[name] = 1 + max((level[d] for d in self.graph[name]), default=0)
+        return level
+
+    def critical_path(self) -> list:
+        """依存の連鎖が最も長い subchart の列 (クリティカルパス) を返す。
+        """
+        level = self.levels()
+        if not level:
+            return []
+        path = [max(self.order, key=lambda n: level[n])]
+        while self.graph[path[-1]]:
+            path.append(max(self.graph[path[-1]], key=lambda n: level[n]))
+        path.reverse()
+        return path
+
+    def max_parallelism(self) -> int:
+        """同じ深さにある subchart 数の最大値、つまり同時に実行されうるデプロイ数の目安を返す。
+        """
+        widths = {}
+        for lv in self.levels().values():
+            widths[lv] = widths.get(lv, 0) + 1
+        return max(widths.values(), default=0)
+
+    def describe(self) -> list:
+        """実行計画を人間が読める形式の行リストで返す。
+        """
+        path = self.critical_path()
+        lines = ['Subcharts: %d' % len(self.graph),
+                 'Critical path (%d): %s' % (len(path), ' -> '.join(path)),
+                 'Max parallel deploys: %d' % self.max_parallelism()]
+        if path:
+            lines.append('Average parallel deploys: %.1f' % (len(self.graph) / len(path)))
+        for name in self.order:
+            lines.append('  %s <- %s' % (name, ', '.join(sorted(self.graph[name])) or '(none)'))
+        return lines
+
+    def run(self, task, max_workers: int = None) -> tuple:
+        """依存関係に従って task を並行に実行する。
+
+        :param task: subchart 名を引数に取る関数。例外を送出した場合はその subchart を失敗とみなす
+        :param int max_workers: 同時に実行する task の最大数。省略時は subchart 数
+        :return: (完了した subchart のリスト, 失敗した subchart 名をキー・例外を値とする辞書,
+                  依存先の失敗により実行しなかった subchart のリスト)
+        :rtype: tuple
+        """
+        done = []
+        failures = {}
+        skipped = []
+        remaining = {name: set(deps) for name, deps in self.graph.items()}
+        running = {}
+        workers = max_workers or len(self.graph) or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while remaining or running:
+                # 依存先が失敗またはスキップされた subchart はスキップする (連鎖的に伝播させる)
+                blocked = True
+                while blocked:
+                    blocked = [name for name, deps in remaining.items() if deps & (failures.keys() | set(skipped))]
+                    for name in blocked:
+                        _logger.warning('Skipping %s because its dependencies did not complete', name)
+                        del remaining[name]
+                        skipped.append(name)
+
+                # 依存先が全て完了した subchart を開始する
+                for name in [n for n in self.order if n in remaining and remaining[n] <= set(done)]:
+                    del remaining[name]
+                    _logger.debug('Starting %s', name)
+                    running[executor.submit(task, name)] = name
+
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.append(name)
+                    except Exception as e:
+                        _logger.error('%s failed: %s', name, e)
+                        failures[name] = e
+        return done, failures, skipped
@@ -7,34 +7,48 @@
 # See https://opensource.org/licenses/MIT .
 # ---------------------------------------------------------------------------
 
+from __future__ import annotations
+
 import argparse
+import concurrent.futures
 import json
 import os
 import sys
+import time
+import typing
 
-import kubernetes.client.rest
-from kubernetes import config, client
-
-# ホームディレクトリの取得
-if os.name == 'nt':
-    # Windows の場合は USERPROFILE 環境変数を使用
-    home_dir = os.environ.get('USERPROFILE', '')
-else:
-    home_dir = os.environ.get('HOME', '')
+import kubeclient
+from deploy import DeploymentDescriptor
+from informer import NamespaceInformer, release_of
+from scheduler import DeployScheduler
 
-# --config オプションが指定されなかった時にデフォルトで検索する kubeconfig ファイルのパス
-# KUBECONFIG 環境変数が空であった場合は取り除くために filter を使用
-DEFAULT_KUBECONFIG = list(filter(None, [
-    os.path.join(os.path.curdir, 'kubeconfig'),
-    os.environ.get('KUBECONFIG', ''),
-    os.path.join(home_dir, '.kube', 'config')
-]))
+# kubernetes パッケージは API を使う時点で kubeclient が読み込む。型注釈のためだけに読み込まない
+if typing.TYPE_CHECKING:
+    from kubernetes import client
 
 # --namespace オプションが指定されなかった時に使用する namespace 名
 DEFAULT_NAMESPACE = 'onap'
 
 # --state オプションが指定されなかった時に使用する state ファイルのパス
-DEFAULT_STATE = os.path.join(home_dir, '.onap', 'last-state')
+DEFAULT_STATE = os.path.join(kubeclient.home_dir, '.onap', 'last-state')
+
+# --concurrency オプションが指定されなかった時に同時に実行するスケール操作の数
+DEFAULT_CONCURRENCY = 16
+
+# --retries オプションが指定されなかった時に、失敗したスケール操作をやり直す回数
+DEFAULT_RETRIES = 2
+
+# --wait-timeout オプションが指定されなかった時に、Pod の終了を待つ最大秒数
+DEFAULT_WAIT_TIMEOUT = 600
+
+# Pod の終了待ちの途中経過を表示する間隔 (秒)
+PROGRESS_INTERVAL = 5
+
+# スケール操作をやり直すまでの待ち時間 (秒)
+RETRY_WAIT = 3
+
+# state ファイルの kind と表示名の対応
+KIND_NAMES = {'deployment': 'Deployment', 'statefulSet': 'StatefulSet'}
 
 
 def parse_arguments() -> argparse.Namespace:
@@ -51,150 +65,509 @@ def parse_arguments() -> argparse.Namespace:
                         metavar='FILE')
     parser.add_argument('--state', '-s', help='path to last state file (must be writable).', default=DEFAULT_STATE,
                         metavar='FILE')
-    parser.add_argument('--namespace', '-n', help='kubernetes namespace where ONAP is deployed.',
-                        default=DEFAULT_NAMESPACE)
+    parser.add_argument('--namespace', '-n', action='append', dest='namespaces', metavar='NAMESPACE',
+                        help='kubernetes namespace where ONAP is deployed. can be given several times. '
+                             '(default: %s)' % DEFAULT_NAMESPACE)
+    parser.add_argument('--all-namespaces', '-A', action='store_true',
+                        help='stop: all namespaces. start: all namespaces recorded in the state file.')
+    parser.add_argument('--selector', '-l', metavar='SELECTOR',
+                        help='label selector to choose the deployments/statefulsets to scale.')
+    parser.add_argument('--field-selector', metavar='SELECTOR',
+                        help='field selector to choose the deployments/statefulsets to scale.')
     parser.add_argument('--force', '-f', action='store_true',
                         help='force to do even if the specified action is the same as last time')
+    parser.add_argument('--concurrency', '-j', type=int, default=DEFAULT_CONCURRENCY, metavar='N',
+                        help='max number of scale operations run at once (default: %d)' % DEFAULT_CONCURRENCY)
+    parser.add_argument('--descriptor', '-d', metavar='FILE',
+                        help='deployment descriptor (e.g. deploydesc.yaml). start restores replicas wave by wave '
+                             'following its deploy order and waits for each wave to be ready.')
+    parser.add_argument('--wave-timeout', type=int, metavar='SECONDS',
+                        help='max seconds to wait for a wave to be ready (default: readiness_timeout of descriptor)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the planned replica changes without scaling anything or updating the state file')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, metavar='N',
+                        help='number of retry passes for failed scale operations (default: %d)' % DEFAULT_RETRIES)
+    parser.add_argument('--wait', action='store_true',
+                        help='stop: wait until the pods of the scaled deployments/statefulsets are terminated.')
+    parser.add_argument('--wait-timeout', type=int, default=DEFAULT_WAIT_TIMEOUT, metavar='SECONDS',
+                        help='max seconds to wait for the pods to be terminated (default: %d)' % DEFAULT_WAIT_TIMEOUT)
     return parser.parse_args()
 
 
-if __name__ == '__main__':
+def list_workloads(apps_v1: client.AppsV1Api, namespaces: list = None, label_selector: str = None,
+                   field_selector: str = None) -> dict:
+    """Deployment, StatefulSet を種別ごとに 1 回の一覧取得で取得する。
+
+    対象が 1 つの namespace の場合は namespace 単位で、複数または全ての namespace の場合はクラスタ全体で一覧取得し、
+    対象外の namespace を除外する。
+
+    :param list namespaces: 対象の namespace のリスト。None の場合は全ての namespace
+    :return: (namespace, kind, name) をキー、オブジェクトを値とする辞書。kind は state ファイルと同じ表記
+    :rtype: dict
+    """
+    selectors = {k: v for k, v in [('label_selector', label_selector), ('field_selector', field_selector)] if v}
+    if namespaces is not None and len(namespaces) == 1:
+        results = [('deployment', apps_v1.list_namespaced_deployment(namespaces[0], **selectors)),
+                   ('statefulSet', apps_v1.list_namespaced_stateful_set(namespaces[0], **selectors))]
+    else:
+        results = [('deployment', apps_v1.list_deployment_for_all_namespaces(**selectors)),
+                   ('statefulSet', apps_v1.list_stateful_set_for_all_namespaces(**selectors))]
+    workloads = {}
+    for kind, resp in results:
+        for obj in resp.items:
+            if namespaces is None or obj.metadata.namespace in namespaces:
+                workloads[(obj.metadata.namespace, kind, obj.metadata.name)] = obj
+    return workloads
+
+
+def load_state(state_file: str) -> dict:
+    """state ファイルを読み込み、namespace ごとの状態を返す。
+
+    旧形式 ({'last_action': ..., 'data': [...]}) のファイルは項目の namespace ごとに分けて読み込む。
+
+    :return: namespace 名をキー、{'last_action': ..., 'data': [...]} を値とする辞書
+    :rtype: dict
+    """
+    with open(state_file, 'r') as f:
+        state_data = json.load(f)
+    if 'namespaces' in state_data:
+        return state_data['namespaces']
+    states = {}
+    for item in state_data.get('data') or []:
+        state = states.setdefault(item['namespace'], {'last_action': state_data['last_action'], 'data': []})
+        state['data'].append(item)
+    return states
+
+
+def save_state(state_file: str, states: dict) -> None:
+    """namespace ごとの状態を state ファイルに書き込む。"""
+    # state_file を格納する親ディレクトリを作成する
+    if os.path.dirname(state_file):
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(state_file, 'w') as f:
+        json.dump({'version': 2, 'namespaces': states}, f)
+
+
+def check_last_action(states: dict, namespaces: list, action: str, force: bool) -> list:
+    """前回と同じ action を実行しようとしている namespace を除いて、処理対象の namespace のリストを返す。
+
+    force が指定された場合は除かない。全ての namespace が除かれる場合は中止する。
+    """
+    repeated = [ns for ns in namespaces if states.get(ns, {}).get('last_action') == action]
+    if not repeated:
+        return namespaces
+    if force:
+        print('warning: last action of %s was "%s" but do the same anyway' % (', '.join(repeated), action))
+        return namespaces
+    rest = [ns for ns in namespaces if ns not in repeated]
+    if not rest:
+        print('error: last action of %s was "%s". aborted.' % (', '.join(repeated), action))
+        sys.exit(3)
+    print('warning: last action of %s was "%s". skipped' % (', '.join(repeated), action))
+    return rest
+
+
+def plan_scale(items: list, workloads: dict, target) -> tuple:
+    """一覧取得で得た現在のレプリカ数と目標値を比較し、実際に変更が必要な項目を求める。
+
+    :param list items: state ファイルの項目のリスト
+    :param dict workloads: list_workloads の戻り値
+    :param target: 項目を受け取り、設定するレプリカ数を返す関数
+    :return: ((項目, 現在のレプリカ数, 目標のレプリカ数) のリスト, 既に目標値の項目数, 見つからなかった項目のリスト)
+    :rtype: tuple
+    """
+    changes = []
+    unchanged = 0
+    missing = []
+    for item in items:
+        obj = workloads.get((item['namespace'], item['kind'], item['name']))
+        if obj is None:
+            print(f"warning: ns={item['namespace']} {KIND_NAMES[item['kind']]} {item['name']} not found")
+            missing.append(item)
+            continue
+        current = obj.spec.replicas or 0
+        replicas = target(item)
+        if current == replicas:
+            unchanged += 1
+        else:
+            changes.append((item, current, replicas))
+    return changes, unchanged, missing
+
+
+def print_plan(changes: list, unchanged: int, detail: bool = True) -> None:
+    """plan_scale で求めた変更内容を出力する。detail が False の場合は件数だけを出力する。"""
+    if detail:
+        for item, current, replicas in changes:
+            print(f"ns={item['namespace']} {KIND_NAMES[item['kind']]} {item['name']} {current} ==> {replicas}")
+    print('info: %d item(s) to scale, %d item(s) already at the target replicas' % (len(changes), unchanged))
+
+
+def scale_item(apps_v1: client.AppsV1Api, item: dict, current: int, replicas: int) -> None:
+    """state ファイルの 1 項目が示すリソースのレプリカ数を、scale サブリソースへの 1 回のパッチで変更する。
+
+    :raises kubernetes.client.rest.ApiException: API 呼び出しに失敗した場合
+    """
+    # JSON Patch で spec.replicas だけを書き換える。事前の read は不要
+    body = [{'op': 'replace', 'path': '/spec/replicas', 'value': replicas}]
+    if item['kind'] == 'deployment':
+        apps_v1.patch_namespaced_deployment_scale(item['name'], item['namespace'], body)
+    elif item['kind'] == 'statefulSet':
+        apps_v1.patch_namespaced_stateful_set_scale(item['name'], item['namespace'], body)
+    # 複数のスレッドから出力されるため、改行を含めて 1 回で書き込む
+    print(f"ns={item['namespace']} {KIND_NAMES[item['kind']]} {item['name']} scaled {current} ==> {replicas}\n", end='')
+
+
+def scale_items(apps_v1: client.AppsV1Api, changes: list, concurrency: int) -> list:
+    """複数のリソースのレプリカ数を並行して変更する。
+
+    :param list changes: plan_scale で求めた (項目, 現在のレプリカ数, 目標のレプリカ数) のリスト
+    :param int concurrency: 同時に実行するスケール操作の最大数
+    :return: スケールに失敗した changes の要素のリスト
+    :rtype: list
+    """
+    import urllib3
+    from kubernetes.client.rest import ApiException
+
+    failed = []
+    if not changes:
+        return failed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(changes)))) as executor:
+        futures = {executor.submit(scale_item, apps_v1, *change): change for change in changes}
+        for future in concurrent.futures.as_completed(futures):
+            change = futures[future]
+            item = change[0]
+            try:
+                future.result()
+            except (ApiException, urllib3.exceptions.HTTPError) as e:
+                print(f"ns={item['namespace']} {item['kind']} {item['name']} SCALE FAILED ({e})")
+                failed.append(change)
+    return failed
+
+
+def scale_with_retry(apps_v1: client.AppsV1Api, changes: list, concurrency: int, retries: int) -> list:
+    """scale_items を実行し、失敗した項目だけを最大 retries 回やり直す。
+
+    :return: やり直しても失敗した項目のリスト
+    :rtype: list
+    """
+    failed = scale_items(apps_v1, changes, concurrency)
+    for attempt in range(1, retries + 1):
+        if not failed:
+            break
+        print('info: retrying %d failed item(s) (%d/%d)' % (len(failed), attempt, retries))
+        time.sleep(RETRY_WAIT)
+        failed = scale_items(apps_v1, failed, concurrency)
+    return [item for item, current, replicas in failed]
+
+
+def group_waves(data: list, workloads: dict, desc: DeploymentDescriptor) -> list:
+    """state ファイルの項目を、デプロイ定義の依存関係に従ったウェーブに分ける。
+
+    各項目は Helm の Release 名 ('<release_name>-<subchart>') から subchart を求め、依存の深さが同じ subchart を
+    同じウェーブにまとめる。デプロイ定義に含まれない項目は最後のウェーブに入れる。
+
+    :param dict workloads: list_workloads の戻り値
+    :return: (ウェーブに含まれる subchart 名のリスト, 項目のリスト) のリスト。起動する順に並ぶ
+    :rtype: list
+    """
+    levels = DeployScheduler(desc.dependency_graph()).levels()
+    last = max(levels.values(), default=0) + 1
+    prefix = desc.release_name + '-'
+    waves = {}
+    for item in data:
+        obj = workloads.get((item['namespace'], item['kind'], item['name']))
+        release = release_of(obj) if obj is not None else None
+        subchart = release[len(prefix):] if release and release.startswith(prefix) else None
+        wave = levels.get(subchart, last)
+        subcharts, items = waves.setdefault(wave, (set(), []))
+        subcharts.add(subchart if wave != last else '(others)')
+        items.append(item)
+    return [(sorted(waves[k][0]), waves[k][1]) for k in sorted(waves)]
+
+
+def wait_pods_terminated(apps_v1: client.AppsV1Api, items: list, workloads: dict, timeout: float) -> list:
+    """停止した項目の Pod が全て終了するまで待機する。
+
+    namespace ごとに Pod を 1 本の watch で監視し、各リソースのセレクタに一致する Pod が無くなるのを待つ。
+
+    :param dict workloads: list_workloads の戻り値
+    :param float timeout: 制限時間 (秒)
+    :return: 制限時間内に Pod が無くならなかった項目のリスト
+    :rtype: list
+    """
+    from kubernetes import client
+
+    # セレクタの無いリソースは Pod を特定できないため待機しない
+    selectors = {}
+    for item in items:
+        selector = workloads[(item['namespace'], item['kind'], item['name'])].spec.selector
+        if selector is None or not (selector.match_labels or selector.match_expressions):
+            print(f"warning: ns={item['namespace']} {KIND_NAMES[item['kind']]} {item['name']} has no pod selector. "
+                  "not waiting for its pods")
+            continue
+        selectors[id(item)] = selector
+    items = [item for item in items if id(item) in selectors]
+    if not items:
+        return []
+
+    core_v1 = client.CoreV1Api(apps_v1.api_client)
+    informers = {}
+    for ns in sorted({item['namespace'] for item in items}):
+        informers[ns] = NamespaceInformer(ns, {'Pod': core_v1.list_namespaced_pod})
+        informers[ns].start()
+    try:
+        for informer in informers.values():
+            informer.wait_for_sync()
+
+        def remaining_pods() -> dict:
+            result = {}
+            for item in items:
+                pods = informers[item['namespace']].select_by('Pod', selectors[id(item)])
+                if pods:
+                    result[id(item)] = (item, len(pods))
+            return result
+
+        deadline = time.monotonic() + timeout
+        remaining = remaining_pods()
+        while remaining:
+            total = sum(count for item, count in remaining.values())
+            print('info: waiting for %d pod(s) of %d item(s) to terminate' % (total, len(remaining)))
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # Pod が残っている namespace の 1 つを監視し、その namespace の Pod が全て終了した時点ですぐに戻る
+            ns = next(iter(remaining.values()))[0]['namespace']
+            informers[ns].wait_until(
+                lambda: all(item['namespace'] != ns for item, count in remaining_pods().values()),
+                min(PROGRESS_INTERVAL, left))
+            remaining = remaining_pods()
+    finally:
+        for informer in informers.values():
+            informer.stop()
+    return [item for item, count in remaining.values()]
+
+
+def wait_wave_ready(informers: dict, items: list, timeout: float) -> list:
+    """項目のリソースが保存されている replicas の数だけ Ready になるまで待機する。
+
+    :param dict informers: namespace 名をキー、NamespaceInformer を値とする辞書
+    :param float timeout: 制限時間 (秒)
+    :return: 制限時間内に Ready にならなかった項目のリスト
+    :rtype: list
+    """
+    deadline = time.monotonic() + timeout
+    not_ready = []
+
+    for ns in sorted({item['namespace'] for item in items}):
+        informer = informers[ns]
+        targets = [item for item in items if item['namespace'] == ns]
+
+        def pending() -> list:
+            result = []
+            for item in targets:
+                obj = informer.get(KIND_NAMES[item['kind']], item['name'])
+                ready = (obj.status.ready_replicas or 0) if obj is not None and obj.status else 0
+                if obj is None or obj.spec.replicas != item['replicas'] or ready < item['replicas']:
+                    result.append(item)
+            return result
+
+        informer.wait_until(lambda: not pending(), max(0.0, deadline - time.monotonic()))
+        not_ready.extend(pending())
+    return not_ready
+
+
+def start_in_waves(apps_v1: client.AppsV1Api, data: list, workloads: dict, desc: DeploymentDescriptor,
+                   args) -> tuple:
+    """デプロイ定義のウェーブ順に replicas を復元し、ウェーブごとに Ready になるのを待ってから次へ進む。
+
+    :param dict workloads: list_workloads の戻り値
+
+    :return: (スケールに失敗した項目のリスト, Ready にならなかった項目のリスト)
+    :rtype: tuple
+    """
+    timeout = args.wave_timeout or desc.readiness_timeout
+    # namespace ごとに 1 つのキャッシュを watch で更新し、Ready 判定に使用する
+    informers = {}
+    for ns in sorted({item['namespace'] for item in data}):
+        informers[ns] = NamespaceInformer(ns, {
+            'Deployment': apps_v1.list_namespaced_deployment,
+            'StatefulSet': apps_v1.list_namespaced_stateful_set,
+        }, args.selector)
+        informers[ns].start()
+    try:
+        for informer in informers.values():
+            informer.wait_for_sync()
+
+        failed_items = []
+        not_ready_items = []
+        waves = group_waves(data, workloads, desc)
+        for number, (subcharts, items) in enumerate(waves, 1):
+            print('info: wave %d/%d: %d item(s) of %s' % (number, len(waves), len(items), ', '.join(subcharts)))
+            changes, unchanged, missing = plan_scale(items, workloads, lambda item: item['replicas'])
+            print_plan(changes, unchanged, args.dry_run)
+            if args.dry_run:
+                continue
+            started = time.monotonic()
+            failed = missing + scale_with_retry(apps_v1, changes, args.concurrency, args.retries)
+            failed_items.extend(failed)
+            not_ready = wait_wave_ready(informers, [item for item in items if item not in failed], timeout)
+            if not_ready:
+                print('warning: wave %d is not ready after %d seconds. continuing with the next wave' % (
+                    number, timeout))
+                for item in not_ready:
+                    print(f"  ns={item['namespace']} {KIND_NAMES[item['kind']]} {item['name']}")
+                not_ready_items.extend(not_ready)
+            else:
+                print('info: wave %d is ready (%.1f seconds)' % (number, time.monotonic() - started))
+        return failed_items, not_ready_items
+    finally:
+        for informer in informers.values():
+            informer.stop()
+
+
+def report_failures(failed_items: list) -> None:
+    """スケールに失敗した項目を出力し、0 以外の終了コードで終了する。"""
+    if not failed_items:
+        return
+    print('error: failed to scale %d item(s):' % len(failed_items))
+    for item in failed_items:
+        print(f"  ns={item['namespace']} {item['kind']} {item['name']}")
+    sys.exit(5)
+
+
+def main():
     # コマンドライン引数処理
     args = parse_arguments()
 
-    # 引数で指定された場合はその値を使い、そうでない場合はデフォルト値を使用
-    config_candidate = [args.config] if args.config else DEFAULT_KUBECONFIG
     state_file = args.state
-    namespace = args.namespace
+    # None は全ての namespace を表す
+    namespaces = None if args.all_namespaces else sorted(set(args.namespaces or [DEFAULT_NAMESPACE]))
     action = args.action
 
-    # config_candidate リストにあるファイルのどれかが読み込めるかチェックする
-    for kubepath in config_candidate:
-        if os.path.exists(kubepath):
-            print('info: using kube config file: ' + kubepath)
-            config.load_kube_config(kubepath)
-            break
-    else:
-        print('error: cannot read any of kubeconfig file(s): %s' % config_candidate)
+    # 引数で指定された場合はその値を使い、そうでない場合はデフォルト値を使用
+    try:
+        kubepath = kubeclient.load_config(args.config)
+    except FileNotFoundError as e:
+        print('error: %s' % e)
         sys.exit(1)
+    print('info: using kube config file: ' + kubepath)
 
     print('info: using state file: ' + state_file)
-    print('info: using namespace: ' + namespace)
+    print('info: using namespace: ' + (', '.join(namespaces) if namespaces is not None else '(all)'))
+    if args.selector or args.field_selector:
+        print('info: using selector: label=%s field=%s' % (args.selector, args.field_selector))
 
-    # APIオブジェクト生成
-    # v1 = client.CoreV1Api()
-    apps_v1 = client.AppsV1Api()
+    # APIオブジェクト生成。並行してスケールするため、同時実行数分の接続を使い回す
+    apps_v1 = kubeclient.apps_api(pool_size=args.concurrency)
 
-    # state ファイルから前回の状態を読み出す
-    last_action = 'none'
+    # state ファイルから namespace ごとの前回の状態を読み出す
+    states = {}
     try:
-        with open(state_file, 'r') as f:
-            state_data = json.load(f)
-            # 最後に行われた action
-            last_action = state_data['last_action']
-            # 最後の各リソースの状態
-            data = state_data['data']
+        states = load_state(state_file)
     except Exception:
         # エラーの場合は処理をスキップ
         print('info: skip processing last state file')
 
     if action == 'start':
-        if last_action == 'start':
-            if args.force:
-                print('warning: last action was "' + last_action + '" but do the same anyway')
-            else:
-                print('error: last action was "' + last_action + '". aborted.')
-                sys.exit(3)
-        if last_action == 'none' or data is None or len(data) == 0:
+        # 全ての namespace が指定された場合は state ファイルに記録されている namespace を対象とする
+        if namespaces is None:
+            namespaces = sorted(states)
+        namespaces = check_last_action(states, namespaces, action, args.force)
+        data = [item for ns in namespaces for item in states.get(ns, {}).get('data') or []]
+        if not data:
             print('error: no last state data. cannot restore to original state. aborted.')
             sys.exit(4)
 
-        failed_items = []
-        for item in data:
-            kind = item['kind']
+        # 現在のレプリカ数を一覧取得する。セレクタが指定された場合は一致したリソースだけを復元する
+        workloads = list_workloads(apps_v1, namespaces, args.selector, args.field_selector)
+        if args.selector or args.field_selector:
+            data = [item for item in data if (item['namespace'], item['kind'], item['name']) in workloads]
+            print('info: %d item(s) match the selector' % len(data))
+
+        not_ready_items = []
+        if args.descriptor:
+            # デプロイ定義の順序に従ってウェーブごとに起動する
             try:
-                if kind == 'deployment':
-                    scale = apps_v1.read_namespaced_deployment_scale(item['name'], item['namespace'])
-                    # replicas を復元する
-                    scale_org = scale.spec.replicas
-                    scale.spec.replicas = item['replicas']
-                    response = apps_v1.patch_namespaced_deployment_scale(item['name'], item['namespace'], scale)
-                    print(f"ns={item['namespace']} Deployment {item['name']} scaled {scale_org} ==> {scale}")
-                elif kind == 'statefulSet':
-                    scale = apps_v1.read_namespaced_stateful_set_scale(item['name'], item['namespace'])
-                    # replicas を復元する
-                    scale_org = scale.spec.replicas
-                    scale.spec.replicas = item['replicas']
-                    response = apps_v1.patch_namespaced_stateful_set_scale(item['name'], item['namespace'], scale)
-                    print(f"ns={item['namespace']} StatefulSet {item['name']} scaled {scale_org} ==> {scale}")
-            except kubernetes.client.rest.ApiException as e:
-                print(f"ns={item['namespace']} {item['kind']} {item['name']} SCALE FAILED")
-                failed_items.append(item)
+                desc = DeploymentDescriptor.from_file(args.descriptor)
+            except (OSError, KeyError, ValueError) as e:
+                print('error: failed to load descriptor file %s: %s' % (args.descriptor, e))
+                sys.exit(1)
+            failed_items, not_ready_items = start_in_waves(apps_v1, data, workloads, desc, args)
+            if args.dry_run:
+                return
+        else:
+            # 保存されている replicas と異なるものだけを復元する
+            changes, unchanged, missing = plan_scale(data, workloads, lambda item: item['replicas'])
+            print_plan(changes, unchanged, args.dry_run)
+            if args.dry_run:
+                return
+            failed_items = missing + scale_with_retry(apps_v1, changes, args.concurrency, args.retries)
+        if failed_items:
+            # 失敗した場合は last_action を更新せず、もう一度 start を実行できるようにする
+            report_failures(failed_items)
 
         # state ファイルの last_action を更新する
-        last_action = action
-        with open(state_file, 'w') as f:
-            json.dump({'last_action': action, 'data': data}, f)
+        for ns in {item['namespace'] for item in data}:
+            states[ns]['last_action'] = action
+        save_state(state_file, states)
+        if not_ready_items:
+            print('error: %d item(s) did not become ready in time' % len(not_ready_items))
+            sys.exit(6)
 
     elif action == 'stop':
-        if last_action == 'stop':
-            if args.force:
-                print('warning: last action was "' + last_action + '" but do the same anyway')
-            else:
-                print('error: last action was "' + last_action + '". aborted.')
-                sys.exit(3)
-        deployments = apps_v1.list_namespaced_deployment(namespace)
+        # 一覧取得の結果を state ファイルの内容と、スケール要否の判定の両方に使用する
+        workloads = list_workloads(apps_v1, namespaces, args.selector, args.field_selector)
+        found = check_last_action(states, sorted({ns for ns, kind, name in workloads}), action, args.force)
         data = []
-        # TODO: 内包表記に変える
-        for deployment in deployments.items:
-            # print('name=%s, desired=%s, ready=%s' % (
-            #     deployment.metadata.name, deployment.status.replicas, deployment.status.ready_replicas))
-            if deployment.status.replicas is None:
+        for (ns, kind, name), obj in workloads.items():
+            if obj.status.replicas is None or ns not in found:
                 continue
             data.append({
-                'namespace': namespace,
-                'kind': 'deployment',
-                'name': deployment.metadata.name,
-                'replicas': deployment.status.replicas
+                'namespace': ns,
+                'kind': kind,
+                'name': name,
+                'replicas': obj.status.replicas
             })
 
-        stateful_sets = apps_v1.list_namespaced_stateful_set(namespace)
-        for stateful_set in stateful_sets.items:
-            print('name=%s, desired=%s, ready=%s' % (
-                stateful_set.metadata.name, stateful_set.status.replicas, stateful_set.status.ready_replicas))
-            if stateful_set.status.replicas is None:
-                continue
-            data.append({
-                'namespace': namespace,
-                'kind': 'statefulSet',
-                'name': stateful_set.metadata.name,
-                'replicas': stateful_set.status.replicas
-            })
+        changes, unchanged, missing = plan_scale(data, workloads, lambda item: 0)
+        print_plan(changes, unchanged, args.dry_run)
+        if args.dry_run:
+            return
 
-        # state_file を格納する親ディレクトリを作成する
-        if os.path.dirname(state_file):
-            os.makedirs(os.path.dirname(state_file), exist_ok=True)
-        with open(state_file, 'w') as f:
-            json.dump({'last_action': action, 'data': data}, f)
+        # namespace ごとに記録する。セレクタで一部だけを停止した場合は、記録済みの他の項目を残す
+        for ns in found:
+            items = [item for item in data if item['namespace'] == ns]
+            saved = states.get(ns, {}).get('data') or []
+            if states.get(ns, {}).get('last_action') == action:
+                # --force で停止済みの namespace を再度停止した場合。現在の replicas は 0 のため、記録済みの値は
+                # 上書きせず、記録に無い項目だけを追加する
+                keys = {(item['kind'], item['name']) for item in saved}
+                states[ns] = {'last_action': action,
+                              'data': saved + [item for item in items if (item['kind'], item['name']) not in keys]}
+                continue
+            keys = {(item['kind'], item['name']) for item in items}
+            kept = [item for item in saved
+                    if (item['kind'], item['name']) not in keys] if args.selector or args.field_selector else []
+            states[ns] = {'last_action': action, 'data': kept + items}
+        save_state(state_file, states)
 
-        failed_items = []
-        for item in data:
-            try:
-                if item['kind'] == 'deployment':
-                    scale = apps_v1.read_namespaced_deployment_scale(item['name'], item['namespace'])
-                    scale_org = scale.spec.replicas
-                    scale.spec.replicas = 0
-                    response = apps_v1.patch_namespaced_deployment_scale(item['name'], item['namespace'], scale)
-                    print(f"ns={item['namespace']} {item['kind']} {item['name']} scaled {scale_org} ==> {scale}")
-                elif item['kind'] == 'statefulSet':
-                    scale = apps_v1.read_namespaced_stateful_set_scale(item['name'], item['namespace'])
-                    scale_org = scale.spec.replicas
-                    scale.spec.replicas = 0
-                    response = apps_v1.patch_namespaced_stateful_set_scale(item['name'], item['namespace'], scale)
-                    print(f"ns={item['namespace']} {item['kind']} {item['name']} scaled {scale_org} ==> {scale}")
-            except kubernetes.client.rest.ApiException as e:
-                print(f"ns={item['namespace']} {item['kind']} {item['name']} SCALE FAILED")
-                failed_items.append(item)
+        failed_items = scale_with_retry(apps_v1, changes, args.concurrency, args.retries)
+        not_terminated = []
+        if args.wait:
+            scaled = [item for item, current, replicas in changes if item not in failed_items]
+            not_terminated = wait_pods_terminated(apps_v1, scaled, workloads, args.wait_timeout)
+        report_failures(failed_items)
+        if not_terminated:
+            print('error: pods of %d item(s) are still running:' % len(not_terminated))
+            for item in not_terminated:
+                print(f"  ns={item['namespace']} {item['kind']} {item['name']}")
+            sys.exit(7)
+        if args.wait:
+            print('info: all pods terminated')
     else:
         print('error: unknown action: ' + action)
         sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
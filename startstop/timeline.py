@@ -0,0 +1,88 @@
+# ---------------------------------------------------------------------------
+# timeline.py
+#
+# Copyright (c) 2021 Satoshi Fujii
+#
+# This software is released under the MIT license.
+# See https://opensource.org/licenses/MIT .
+# ---------------------------------------------------------------------------
+
+import contextlib
+import json
+import threading
+import time
+
+
+class Timeline:
+    """処理の開始・終了時刻を記録し、Chrome trace 形式での出力と所要時間の集計を行う。
+
+    記録した区間は chrome://tracing や Perfetto (https://ui.perfetto.dev) で読み込んで確認できる。
+    複数のスレッドから同時に記録してよい。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, track: str = None, **args):
+        """with 文のブロックの実行区間を記録する。
+
+        :param str name: 区間の名前
+        :param str category: 区間の分類 (stage, subchart, helm, readiness など)
+        :param str track: 表示上のトラック名。省略時は category を使用する
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), track, **args)
+
+    def add(self, name: str, category: str, start: float, end: float, track: str = None, **args) -> None:
+        """区間を記録する。
+
+        :param float start: 開始時刻 (UNIX 時間, 秒)
+        :param float end: 終了時刻 (UNIX 時間, 秒)
+        """
+        with self._lock:
+            self._spans.append({'name': name, 'cat': category, 'start': start, 'end': end,
+                                'track': track or category, 'args': args})
+
+    def spans(self, category: str = None) -> list:
+        """記録された区間を開始時刻順に返す。category を指定した場合はその分類のみ返す。
+        """
+        with self._lock:
+            spans = [s for s in self._spans if category is None or s['cat'] == category]
+        return sorted(spans, key=lambda s: s['start'])
+
+    def write(self, path: str) -> None:
+        """記録された区間を Chrome trace 形式 (JSON) でファイルに書き出す。
+        """
+        spans = self.spans()
+        origin = min((s['start'] for s in spans), default=0)
+        tracks = {}
+        events = []
+        for s in spans:
+            tid = tracks.setdefault(s['track'], len(tracks) + 1)
+            events.append({'name': s['name'], 'cat': s['cat'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': round((s['start'] - origin) * 1e6), 'dur': round((s['end'] - s['start']) * 1e6),
+                           'args': dict(s['args'], start=s['start'], end=s['end'])})
+        for track, tid in tracks.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': track}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, count: int = 10) -> list:
+        """所要時間の長い区間の一覧と、分類ごとの合計時間を表形式の行リストで返す。
+        """
+        spans = self.spans()
+        lines = ['%-12s %10s  %s' % ('CATEGORY', 'SECONDS', 'NAME')]
+        for s in sorted(spans, key=lambda s: s['start'] - s['end'])[:count]:
+            lines.append('%-12s %10.1f  %s' % (s['cat'], s['end'] - s['start'], s['name']))
+        totals = {}
+        for s in spans:
+            total, num = totals.get(s['cat'], (0.0, 0))
+            totals[s['cat']] = (total + s['end'] - s['start'], num + 1)
+        lines.append('%-12s %10s  %s' % ('CATEGORY', 'TOTAL SEC', 'COUNT'))
+        for category, (total, num) in sorted(totals.items(), key=lambda x: -x[1][0]):
+            lines.append('%-12s %10.1f  %d' % (category, total, num))
+        return lines